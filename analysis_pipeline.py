@@ -0,0 +1,250 @@
+# Pipeline a stadi per l'analisi delle immagini
+# Decodifica, triage e ridimensionamento (OpenCV rilascia il GIL) girano in un pool di thread,
+# l'inferenza in uno stadio dedicato e la post-elaborazione con il riepilogo in un altro.
+# Gli stadi sono collegati da code limitate, così le immagini di richieste diverse
+# si sovrappongono: mentre il modello elabora un'immagine, le successive vengono già preparate.
+# Ogni stadio riporta l'utilizzo dei propri worker per individuare il collo di bottiglia
+# e ogni immagine i tempi di attesa e di elaborazione per stadio (header Server-Timing).
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+DECODE = "decode"
+INFERENCE = "inference"
+POSTPROCESS = "postprocess"
+
+# Modalità di risultato: dizionario come analyze_surface o array come analyze_batch
+RESULT = "result"
+ARRAYS = "arrays"
+
+
+class _Job:
+    def __init__(self, analyzer, source, mode):
+        self.analyzer = analyzer
+        self.source = source
+        self.mode = mode
+        self.future = Future()
+        self.triage = None
+        self.processed_image = None
+        self.original_image = None
+        self.raw = None
+        self.result = None
+        # Millisecondi per stadio ("decode") e di attesa in coda ("decode_queue")
+        self.timings = {}
+        self.enqueued_at = None
+
+
+class _Stage:
+    """
+    Stadio della pipeline con un numero fisso di worker
+    """
+
+    def __init__(self, name, fn, workers, input_queue, output_queue):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.input_queue = input_queue
+        self.output_queue = output_queue
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+        self._threads = [threading.Thread(target=self._run, name=f"pipeline-{name}-{i}", daemon=True)
+                         for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def reset_stats(self):
+        with self._lock:
+            self.items = 0
+            self.busy_seconds = 0.0
+            # Tempo passato ad attendere spazio nella coda successiva (stadio a valle lento)
+            self.blocked_seconds = 0.0
+            self.max_queue_depth = 0
+            self.started_at = time.perf_counter()
+
+    def _run(self):
+        while True:
+            job = self.input_queue.get()
+            if job is None:
+                return
+
+            start = time.perf_counter()
+            job.timings[f"{self.name}_queue"] = (start - job.enqueued_at) * 1000
+            try:
+                self.fn(job)
+            except Exception as e:
+                print(f"Errore nello stadio {self.name}: {e}")
+                job.result = _error_result(job, str(e))
+            busy = time.perf_counter() - start
+            job.timings[self.name] = busy * 1000
+
+            blocked = 0.0
+            if job.result is not None:
+                job.future.set_result(job.result)
+            else:
+                # L'attesa per uno spazio nella coda successiva conta come attesa dello stadio a valle
+                job.enqueued_at = start = time.perf_counter()
+                self.output_queue.put(job)
+                blocked = time.perf_counter() - start
+
+            with self._lock:
+                self.items += 1
+                self.busy_seconds += busy
+                self.blocked_seconds += blocked
+                self.max_queue_depth = max(self.max_queue_depth, self.input_queue.qsize())
+
+    def stop(self):
+        for _ in self._threads:
+            self.input_queue.put(None)
+
+    def stats(self):
+        with self._lock:
+            elapsed = max(time.perf_counter() - self.started_at, 1e-9)
+            return {
+                "workers": self.workers,
+                "items": self.items,
+                "queue_depth": self.input_queue.qsize(),
+                "max_queue_depth": self.max_queue_depth,
+                "queue_size": self.input_queue.maxsize,
+                "utilization": self.busy_seconds / (elapsed * self.workers),
+                "blocked_fraction": self.blocked_seconds / (elapsed * self.workers),
+                "average_ms": self.busy_seconds / self.items * 1000 if self.items else 0.0,
+            }
+
+
+def _error_result(job, message, invalid=False):
+    if job.mode == ARRAYS:
+        verdict = job.triage["verdict"] if job.triage else None
+        return {"arrays": None, "error": message, "triage_verdict": verdict}
+    result = {"error": message}
+    if invalid:
+        result["invalid"] = True
+    return result
+
+
+def _merge_timings(timings, jobs):
+    if timings is None:
+        return
+    for job in jobs:
+        for name, duration in job.timings.items():
+            timings[name] = timings.get(name, 0.0) + duration
+
+
+class AnalysisPipeline:
+    """
+    Esegue l'analisi delle superfici in stadi sovrapposti
+    """
+
+    def __init__(self, decode_workers=4, inference_workers=1, postprocess_workers=2, queue_size=16):
+        """
+        Inizializza la pipeline e avvia i worker
+
+        Args:
+            decode_workers: Thread per decodifica, triage e ridimensionamento
+            inference_workers: Thread per l'inferenza del modello
+            postprocess_workers: Thread per rilevazioni, punteggio e riepilogo
+            queue_size: Capacità di ciascuna coda tra gli stadi
+        """
+        self.queues = {
+            DECODE: queue.Queue(maxsize=queue_size),
+            INFERENCE: queue.Queue(maxsize=queue_size),
+            POSTPROCESS: queue.Queue(maxsize=queue_size),
+        }
+        self.stages = [
+            _Stage(DECODE, self._decode, decode_workers, self.queues[DECODE], self.queues[INFERENCE]),
+            _Stage(INFERENCE, self._inference, inference_workers, self.queues[INFERENCE], self.queues[POSTPROCESS]),
+            _Stage(POSTPROCESS, self._postprocess, postprocess_workers, self.queues[POSTPROCESS], None),
+        ]
+
+    def _decode(self, job):
+        analyzer = job.analyzer
+        try:
+            image = analyzer.decode_image(job.source)
+        except Exception as e:
+            job.result = _error_result(job, str(e), invalid=True)
+            return
+
+        job.triage, early = analyzer._run_triage(image)
+        if early is not None:
+            job.result = analyzer._triage_outcome(job.triage, early) if job.mode == ARRAYS else early
+            return
+
+        job.processed_image, job.original_image = analyzer._prepare_image(image)
+
+    def _inference(self, job):
+        job.raw = job.analyzer._infer(job.processed_image, job.original_image)
+        job.processed_image = job.original_image = None
+
+    def _postprocess(self, job):
+        analyzer = job.analyzer
+        if job.mode == ARRAYS:
+            job.result = analyzer._arrays_outcome(job.triage, job.raw)
+        else:
+            job.result = analyzer._with_triage(job.triage, analyzer._postprocess(job.raw))
+
+    def _submit(self, analyzer, source, mode):
+        job = _Job(analyzer, source, mode)
+        job.enqueued_at = time.perf_counter()
+        self.queues[DECODE].put(job)
+        return job
+
+    def submit(self, analyzer, source, mode=RESULT):
+        """
+        Accoda un'immagine; blocca se la prima coda è piena
+
+        Args:
+            analyzer: Istanza di SurfaceAnalyzer da usare per questa immagine
+            source: Byte codificati, percorso, array numpy (BGR) o oggetto PIL
+            mode: RESULT per il formato di analyze_surface, ARRAYS per quello di analyze_batch
+
+        Returns:
+            Future con il risultato
+        """
+        return self._submit(analyzer, source, mode).future
+
+    def analyze(self, analyzer, source, timings=None):
+        """
+        Analizza un'immagine attraverso la pipeline (come analyze_surface)
+
+        Args:
+            analyzer: Istanza di SurfaceAnalyzer
+            source: Immagine da analizzare
+            timings: Dizionario nome -> millisecondi a cui sommare attese ed elaborazione per stadio
+        """
+        job = self._submit(analyzer, source, RESULT)
+        result = job.future.result()
+        _merge_timings(timings, [job])
+        return result
+
+    def analyze_batch(self, analyzer, sources, timings=None):
+        """
+        Analizza più immagini attraverso la pipeline (come analyze_batch)
+
+        Args:
+            analyzer: Istanza di SurfaceAnalyzer
+            sources: Immagini da analizzare
+            timings: Dizionario nome -> millisecondi a cui sommare, per stadio,
+                attese ed elaborazione di tutte le immagini
+        """
+        jobs = [self._submit(analyzer, source, ARRAYS) for source in sources]
+        outcomes = [job.future.result() for job in jobs]
+        _merge_timings(timings, jobs)
+        return analyzer._batch_from_outcomes(outcomes)
+
+    def reset_stats(self):
+        for stage in self.stages:
+            stage.reset_stats()
+
+    def stats(self):
+        """
+        Restituisce utilizzo e code per stadio e lo stadio più carico
+        """
+        stages = {stage.name: stage.stats() for stage in self.stages}
+        bottleneck = max(stages, key=lambda name: stages[name]["utilization"])
+        return {"stages": stages, "bottleneck": bottleneck if stages[bottleneck]["items"] else None}
+
+    def close(self):
+        for stage in self.stages:
+            stage.stop()
@@ -0,0 +1,338 @@
+# Regioni di cambiamento tra le foto prima e dopo la pulizia
+# Allinea le due immagini su copie ridotte (ORB + omografia), calcola una maschera dei
+# cambiamenti e la riduce a pochi riquadri. Il modello neurale viene eseguito solo su
+# questi riquadri e su un piccolo campione delle zone invariate, disposti in un unico
+# mosaico per foto, e i problemi risolti o rimanenti vengono riportati per regione.
+
+import cv2
+import numpy as np
+
+DEFAULT_PARAMS = {
+    # Lato lungo delle copie ridotte per allineamento e maschera
+    "downscale_size": 480,
+    # Punti ORB e corrispondenze minime per stimare l'omografia
+    "orb_features": 1000,
+    "min_matches": 12,
+    # Differenza (0-255) oltre la quale un pixel è considerato cambiato
+    "diff_threshold": 30,
+    # Area minima di una regione, come frazione dell'immagine
+    "min_region_fraction": 0.002,
+    # Margine attorno alle regioni, come frazione del lato lungo
+    "region_margin": 0.03,
+    # Numero massimo di regioni analizzate (le più vicine vengono unite)
+    "max_regions": 4,
+    # Oltre questa frazione di area cambiata conviene analizzare le immagini intere
+    "max_changed_fraction": 0.6,
+    # Riquadri invariati campionati per verificare che non ci siano cambiamenti non rilevati
+    "unchanged_samples": 1,
+    "unchanged_grid": 4,
+    # Sovrapposizione minima tra rilevazioni prima/dopo per considerarle lo stesso problema
+    "match_iou": 0.3,
+    # Lato massimo del mosaico con tutte le regioni (un passaggio per foto); il mosaico
+    # è grande quanto le regioni, arrotondato a multipli di canvas_stride
+    "canvas_size": 640,
+    "canvas_stride": 32,
+}
+
+
+def _downscale(image, size):
+    height, width = image.shape[:2]
+    scale = min(1.0, size / max(height, width))
+    if scale < 1:
+        image = cv2.resize(image, (max(1, int(width * scale)), max(1, int(height * scale))),
+                           interpolation=cv2.INTER_AREA)
+    return image, scale
+
+
+def _gray(image):
+    return cv2.cvtColor(image, cv2.COLOR_RGB2GRAY) if image.ndim == 3 else image
+
+
+def align_images(before, after, params=None):
+    """
+    Allinea l'immagine dopo alla prospettiva dell'immagine prima
+
+    Args:
+        before: Immagine RGB prima della pulizia
+        after: Immagine RGB dopo la pulizia
+        params: Parametri da sovrascrivere rispetto a DEFAULT_PARAMS
+
+    Returns:
+        Tupla (immagine dopo allineata alla dimensione di before, informazioni sull'allineamento)
+    """
+    p = {**DEFAULT_PARAMS, **(params or {})}
+    small_before, scale_before = _downscale(before, p["downscale_size"])
+    small_after, scale_after = _downscale(after, p["downscale_size"])
+
+    orb = cv2.ORB_create(p["orb_features"])
+    kp_before, des_before = orb.detectAndCompute(_gray(small_before), None)
+    kp_after, des_after = orb.detectAndCompute(_gray(small_after), None)
+
+    homography = None
+    inliers = 0
+    if des_before is not None and des_after is not None:
+        matcher = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
+        matches = matcher.match(des_after, des_before)
+        if len(matches) >= p["min_matches"]:
+            src = np.float32([kp_after[m.queryIdx].pt for m in matches]).reshape(-1, 1, 2)
+            dst = np.float32([kp_before[m.trainIdx].pt for m in matches]).reshape(-1, 1, 2)
+            homography, mask = cv2.findHomography(src, dst, cv2.RANSAC, 5.0)
+            inliers = int(mask.sum()) if mask is not None else 0
+            if inliers < p["min_matches"]:
+                homography = None
+
+    # Omografia stimata sulle copie ridotte, riportata alla risoluzione originale
+    to_small_after = np.diag([scale_after, scale_after, 1.0])
+    from_small_before = np.diag([1 / scale_before, 1 / scale_before, 1.0])
+    if homography is None:
+        # Nessun allineamento affidabile: le foto vengono solo portate alla stessa dimensione
+        transform = np.diag([before.shape[1] / after.shape[1], before.shape[0] / after.shape[0], 1.0])
+    else:
+        transform = from_small_before @ homography @ to_small_after
+
+    aligned = cv2.warpPerspective(after, transform, (before.shape[1], before.shape[0]),
+                                  flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+    return aligned, {
+        "aligned": homography is not None,
+        "inliers": inliers,
+        "transform": transform.tolist(),
+    }
+
+
+def change_mask(before, aligned_after, params=None):
+    """
+    Calcola la maschera dei cambiamenti su copie ridotte
+
+    Returns:
+        Tupla (maschera binaria ridotta, scala rispetto all'originale)
+    """
+    p = {**DEFAULT_PARAMS, **(params or {})}
+    small_before, scale = _downscale(before, p["downscale_size"])
+    small_after, _ = _downscale(aligned_after, p["downscale_size"])
+
+    # Differenza nello spazio Lab: la luminosità pesa meno, così i cambi di luce contano poco
+    lab_before = cv2.cvtColor(cv2.GaussianBlur(small_before, (5, 5), 0), cv2.COLOR_RGB2LAB).astype(np.float32)
+    lab_after = cv2.cvtColor(cv2.GaussianBlur(small_after, (5, 5), 0), cv2.COLOR_RGB2LAB).astype(np.float32)
+    diff = np.abs(lab_before - lab_after)
+    distance = 0.5 * diff[..., 0] + diff[..., 1] + diff[..., 2]
+
+    mask = (distance > p["diff_threshold"]).astype(np.uint8)
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel, iterations=2)
+    return mask, scale
+
+
+def _merge_boxes(boxes, max_boxes):
+    # Unisce le coppie di riquadri la cui unione aggiunge meno area finché ne restano max_boxes
+    boxes = [list(box) for box in boxes]
+    while len(boxes) > max_boxes:
+        best = None
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                a, b = boxes[i], boxes[j]
+                union = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                cost = box_area(union) - box_area(a) - box_area(b)
+                if best is None or cost < best[0]:
+                    best = (cost, i, j, union)
+        _, i, j, union = best
+        boxes[i] = union
+        del boxes[j]
+    return boxes
+
+
+def box_area(box):
+    return max(0, box[2] - box[0]) * max(0, box[3] - box[1])
+
+
+def change_regions(mask, scale, image_shape, params=None):
+    """
+    Riduce la maschera dei cambiamenti a riquadri nella risoluzione originale
+
+    Returns:
+        Tupla (lista di riquadri [x1, y1, x2, y2], frazione di area cambiata)
+    """
+    p = {**DEFAULT_PARAMS, **(params or {})}
+    height, width = image_shape[:2]
+    changed_fraction = float(mask.mean()) if mask.size else 0.0
+
+    count, _, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    min_area = p["min_region_fraction"] * mask.size
+    boxes = []
+    for label in range(1, count):
+        x, y, w, h, area = stats[label]
+        if area >= min_area:
+            boxes.append([x, y, x + w, y + h])
+
+    margin = p["region_margin"] * max(height, width)
+    regions = []
+    for box in _merge_boxes(boxes, p["max_regions"]):
+        x1, y1, x2, y2 = (np.array(box, dtype=np.float64) / scale).tolist()
+        regions.append([
+            int(max(0, x1 - margin)), int(max(0, y1 - margin)),
+            int(min(width, x2 + margin)), int(min(height, y2 + margin)),
+        ])
+    return _merge_overlapping(regions), changed_fraction
+
+
+def _merge_overlapping(boxes):
+    # Dopo il margine i riquadri possono sovrapporsi: li uniamo per non analizzare due volte
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                a, b = boxes[i], boxes[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    boxes[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return boxes
+
+
+def sample_unchanged(image_shape, regions, params=None, rng=None):
+    """
+    Sceglie alcune celle di una griglia che non toccano le regioni cambiate
+
+    Returns:
+        Lista di riquadri [x1, y1, x2, y2]
+    """
+    p = {**DEFAULT_PARAMS, **(params or {})}
+    rng = rng or np.random.default_rng()
+    height, width = image_shape[:2]
+    grid = p["unchanged_grid"]
+
+    cells = []
+    for row in range(grid):
+        for col in range(grid):
+            cell = [col * width // grid, row * height // grid, (col + 1) * width // grid, (row + 1) * height // grid]
+            if not any(cell[0] < r[2] and r[0] < cell[2] and cell[1] < r[3] and r[1] < cell[3] for r in regions):
+                cells.append(cell)
+
+    count = min(p["unchanged_samples"], len(cells))
+    if count == 0:
+        return []
+    return [cells[i] for i in rng.choice(len(cells), size=count, replace=False)]
+
+
+def _round_up(value, stride):
+    return max(stride, int(np.ceil(value / stride)) * stride)
+
+
+def _shelf_layout(sizes, width):
+    # Righe da sinistra a destra, regioni più alte per prime
+    order = sorted(range(len(sizes)), key=lambda i: -sizes[i][1])
+    origins = [None] * len(sizes)
+    x = y = row_height = 0
+    for i in order:
+        w, h = sizes[i]
+        if x > 0 and x + w > width:
+            x, y, row_height = 0, y + row_height, 0
+        origins[i] = (x, y)
+        x += w
+        row_height = max(row_height, h)
+    return origins, y + row_height
+
+
+def pack_regions(image, boxes, canvas_size=640, stride=32):
+    """
+    Dispone i ritagli delle regioni in un mosaico grande quanto le regioni stesse
+
+    I ritagli mantengono la scala che avrebbero nell'analisi dell'immagine intera
+    (lato lungo a canvas_size) e vengono ridotti solo se il mosaico supera canvas_size.
+    I lati del mosaico sono multipli di stride, come richiesto dal modello.
+
+    Returns:
+        Tupla (mosaico RGB, posizionamenti (riquadro, origine, scala, dimensione))
+    """
+    height, width = image.shape[:2]
+    scale = min(1.0, canvas_size / max(height, width))
+
+    while True:
+        sizes = [(max(1, int(round((x2 - x1) * scale))), max(1, int(round((y2 - y1) * scale))))
+                 for x1, y1, x2, y2 in boxes]
+        area = sum(w * h for w, h in sizes)
+        canvas_width = min(canvas_size, _round_up(max(max(w for w, _ in sizes), np.sqrt(area)), stride))
+        origins, used_height = _shelf_layout(sizes, canvas_width)
+        fits = (used_height <= canvas_size and all(w <= canvas_width for w, _ in sizes))
+        if fits:
+            break
+        scale *= 0.9
+
+    canvas_height = min(canvas_size, _round_up(used_height, stride))
+    canvas = np.full((canvas_height, canvas_width, 3), 114, dtype=np.uint8)
+
+    placements = []
+    for box, origin, (w, h) in zip(boxes, origins, sizes):
+        x1, y1, x2, y2 = box
+        crop = image[y1:y2, x1:x2]
+        crop_scale = min(w / crop.shape[1], h / crop.shape[0])
+        canvas[origin[1]:origin[1] + h, origin[0]:origin[0] + w] = cv2.resize(
+            crop, (w, h), interpolation=cv2.INTER_AREA if crop_scale < 1 else cv2.INTER_LINEAR)
+        placements.append((box, origin, crop_scale, (w, h)))
+    return canvas, placements
+
+
+def unpack_detections(detections, placements):
+    """
+    Riporta le rilevazioni del mosaico nelle coordinate dell'immagine, per regione
+
+    Returns:
+        Lista (una per regione) di liste di rilevazioni
+    """
+    per_region = [[] for _ in placements]
+    for detection in detections:
+        bx1, by1, bx2, by2 = (float(v) for v in detection["box"])
+        cx, cy = (bx1 + bx2) / 2, (by1 + by2) / 2
+        for i, (box, origin, scale, (width, height)) in enumerate(placements):
+            ox, oy = origin
+            if not (ox <= cx < ox + width and oy <= cy < oy + height):
+                continue
+            # Le rilevazioni che escono dalla cella vengono ritagliate sul suo bordo
+            x1 = (min(max(bx1, ox), ox + width) - ox) / scale + box[0]
+            y1 = (min(max(by1, oy), oy + height) - oy) / scale + box[1]
+            x2 = (min(max(bx2, ox), ox + width) - ox) / scale + box[0]
+            y2 = (min(max(by2, oy), oy + height) - oy) / scale + box[1]
+            per_region[i].append({**detection, "box": [x1, y1, x2, y2]})
+            break
+    return per_region
+
+
+def box_iou(a, b):
+    inter = box_area([max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3])])
+    union = box_area(a) + box_area(b) - inter
+    return inter / union if union > 0 else 0.0
+
+
+def match_problems(before_detections, after_detections, match_iou=0.3):
+    """
+    Confronta i problemi (rilevazioni diverse da clean_surface) di una regione
+
+    Returns:
+        Dizionario con problemi risolti, rimanenti e nuovi
+    """
+    before_problems = [d for d in before_detections if d["label"] != "clean_surface"]
+    after_problems = [d for d in after_detections if d["label"] != "clean_surface"]
+
+    matched_after = set()
+    resolved = []
+    remaining = []
+    for problem in before_problems:
+        match = None
+        for j, candidate in enumerate(after_problems):
+            if j in matched_after or candidate["label"] != problem["label"]:
+                continue
+            if box_iou(problem["box"], candidate["box"]) >= match_iou:
+                match = j
+                break
+        if match is None:
+            resolved.append(problem)
+        else:
+            matched_after.add(match)
+            remaining.append(after_problems[match])
+
+    new = [d for j, d in enumerate(after_problems) if j not in matched_after]
+    return {"resolved": resolved, "remaining": remaining, "new": new}
@@ -0,0 +1,324 @@
+# Formato dei checkpoint mappabile in memoria (safetensors)
+# I tensori vengono letti pigramente tramite mmap, senza deserializzare pickle,
+# e parametri dello scaler e metadati del modello sono salvati nello stesso file.
+#
+# Conversione dei checkpoint esistenti:
+#   python checkpoint_format.py convert-optimizer modello.pt modello.safetensors
+#   python checkpoint_format.py convert-surface yolo_nas.pt yolo_nas.safetensors --architecture yolo_nas_s
+# Confronto dei tempi di caricamento e della memoria di picco:
+#   python checkpoint_format.py benchmark modello.pt modello.safetensors
+#   python checkpoint_format.py benchmark yolo_nas.pt yolo_nas.safetensors --kind surface
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import time
+from datetime import datetime
+
+import numpy as np
+import torch
+
+try:
+    from safetensors import safe_open
+    from safetensors.torch import save_file
+except ImportError:
+    safe_open = None
+    save_file = None
+
+SAFETENSORS_EXTENSION = ".safetensors"
+OPTIMIZER_FORMAT = "cleanai-predictive-v1"
+SURFACE_FORMAT = "cleanai-surface-v1"
+
+MODEL_PREFIX = "model."
+SCALER_MEAN_KEY = "scaler.mean"
+SCALER_SCALE_KEY = "scaler.scale"
+
+
+def is_safetensors_checkpoint(path):
+    return bool(path) and str(path).endswith(SAFETENSORS_EXTENSION)
+
+
+def _require_safetensors():
+    if safe_open is None:
+        raise ImportError("Il pacchetto safetensors è necessario per i checkpoint .safetensors")
+
+
+def save_checkpoint(path, state_dict, metadata, extra_tensors=None):
+    """
+    Salva un checkpoint in formato safetensors
+
+    Args:
+        path: Percorso del file .safetensors
+        state_dict: Pesi del modello
+        metadata: Dizionario di metadati (valori serializzabili in JSON)
+        extra_tensors: Altri tensori da salvare con i pesi (es. parametri dello scaler)
+    """
+    _require_safetensors()
+    tensors = {MODEL_PREFIX + name: tensor.detach().cpu().contiguous() for name, tensor in state_dict.items()}
+    for name, tensor in (extra_tensors or {}).items():
+        tensors[name] = tensor.detach().cpu().contiguous()
+
+    # I metadati di safetensors sono stringhe: i valori vengono codificati in JSON
+    encoded = {key: json.dumps(value) for key, value in metadata.items()}
+    encoded["created_at"] = json.dumps(datetime.now().isoformat())
+
+    # Scrittura atomica tramite file temporaneo
+    tmp_path = path + ".tmp"
+    save_file(tensors, tmp_path, metadata=encoded)
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path, device="cpu"):
+    """
+    Carica un checkpoint safetensors. Sulla CPU i tensori restano mappati
+    sul file e le pagine vengono lette solo quando servono.
+
+    Args:
+        path: Percorso del file .safetensors
+        device: Dispositivo di destinazione
+
+    Returns:
+        Tupla (state_dict, tensori aggiuntivi, metadati)
+    """
+    _require_safetensors()
+    state_dict = {}
+    extra_tensors = {}
+    with safe_open(path, framework="pt", device=str(device)) as f:
+        metadata = {key: json.loads(value) for key, value in (f.metadata() or {}).items()}
+        for key in f.keys():
+            if key.startswith(MODEL_PREFIX):
+                state_dict[key[len(MODEL_PREFIX):]] = f.get_tensor(key)
+            else:
+                extra_tensors[key] = f.get_tensor(key)
+    return state_dict, extra_tensors, metadata
+
+
+def assign_state_dict(model, state_dict):
+    """
+    Carica i pesi nel modello riusando i tensori mappati invece di copiarli
+    """
+    try:
+        model.load_state_dict(state_dict, assign=True)
+    except TypeError:
+        # Versioni di PyTorch senza il parametro assign
+        model.load_state_dict(state_dict)
+    return model
+
+
+def save_optimizer_checkpoint(optimizer, path):
+    """
+    Salva il modello di un OperationalOptimizer in formato safetensors
+
+    Args:
+        optimizer: Istanza di OperationalOptimizer con modello addestrato
+        path: Percorso del file .safetensors
+    """
+    model = optimizer.model
+    extra_tensors = {}
+    if getattr(optimizer.scaler, "mean_", None) is not None:
+        extra_tensors[SCALER_MEAN_KEY] = torch.from_numpy(np.asarray(optimizer.scaler.mean_, dtype=np.float64))
+    if getattr(optimizer.scaler, "scale_", None) is not None:
+        extra_tensors[SCALER_SCALE_KEY] = torch.from_numpy(np.asarray(optimizer.scaler.scale_, dtype=np.float64))
+
+    metadata = {
+        "format": OPTIMIZER_FORMAT,
+        "input_size": model.input_size,
+        "hidden_size": model.hidden_size,
+        "output_size": model.output_size,
+    }
+    save_checkpoint(path, model.state_dict(), metadata, extra_tensors)
+
+
+def load_optimizer_checkpoint(path, device="cpu"):
+    """
+    Carica un checkpoint safetensors di PredictiveModel
+
+    Returns:
+        Dizionario con la stessa struttura dei checkpoint di save_model
+    """
+    state_dict, extra_tensors, metadata = load_checkpoint(path, device)
+    if metadata.get("format") != OPTIMIZER_FORMAT:
+        raise ValueError(f"Formato del checkpoint non riconosciuto: {metadata.get('format')}")
+
+    scaler_mean = extra_tensors.get(SCALER_MEAN_KEY)
+    scaler_scale = extra_tensors.get(SCALER_SCALE_KEY)
+    return {
+        "model_state_dict": state_dict,
+        "input_size": metadata["input_size"],
+        "hidden_size": metadata["hidden_size"],
+        "output_size": metadata["output_size"],
+        "scaler_mean": scaler_mean.cpu().numpy() if scaler_mean is not None else None,
+        "scaler_scale": scaler_scale.cpu().numpy() if scaler_scale is not None else None,
+        "metadata": metadata,
+    }
+
+
+def convert_optimizer_checkpoint(src_path, dst_path):
+    """
+    Converte un checkpoint di OperationalOptimizer.save_model in formato safetensors
+
+    Args:
+        src_path: Checkpoint originale (torch.save)
+        dst_path: Percorso del file .safetensors
+    """
+    checkpoint = torch.load(src_path, map_location="cpu", weights_only=False)
+    extra_tensors = {}
+    if checkpoint.get("scaler_mean") is not None:
+        extra_tensors[SCALER_MEAN_KEY] = torch.from_numpy(np.asarray(checkpoint["scaler_mean"], dtype=np.float64))
+    if checkpoint.get("scaler_scale") is not None:
+        extra_tensors[SCALER_SCALE_KEY] = torch.from_numpy(np.asarray(checkpoint["scaler_scale"], dtype=np.float64))
+
+    metadata = {
+        "format": OPTIMIZER_FORMAT,
+        "input_size": int(checkpoint["input_size"]),
+        "hidden_size": int(checkpoint["hidden_size"]),
+        "output_size": int(checkpoint["output_size"]),
+        "source": os.path.basename(src_path),
+    }
+    save_checkpoint(dst_path, checkpoint["model_state_dict"], metadata, extra_tensors)
+    print(f"Checkpoint convertito in {dst_path}")
+
+
+def convert_surface_checkpoint(src_path, dst_path, architecture="yolo_nas_s", classes=None):
+    """
+    Converte un modello YOLO-NAS salvato con torch.save in formato safetensors.
+    Viene salvato solo lo state_dict: l'architettura è ricostruita al caricamento.
+
+    Args:
+        src_path: Modello originale (oggetto completo o state_dict)
+        dst_path: Percorso del file .safetensors
+        architecture: Nome dell'architettura in super_gradients
+        classes: Elenco delle classi del modello
+    """
+    model = torch.load(src_path, map_location="cpu", weights_only=False)
+    state_dict = model.state_dict() if hasattr(model, "state_dict") else model
+
+    metadata = {
+        "format": SURFACE_FORMAT,
+        "architecture": architecture,
+        "classes": classes,
+        "source": os.path.basename(src_path),
+    }
+    save_checkpoint(dst_path, state_dict, metadata)
+    print(f"Checkpoint convertito in {dst_path}")
+
+
+def load_surface_model(path, device="cpu", default_classes=None):
+    """
+    Ricostruisce un modello YOLO-NAS da un checkpoint safetensors
+
+    Returns:
+        Tupla (modello, classi)
+    """
+    from super_gradients.training import models
+
+    state_dict, _, metadata = load_checkpoint(path, "cpu")
+    if metadata.get("format") != SURFACE_FORMAT:
+        raise ValueError(f"Formato del checkpoint non riconosciuto: {metadata.get('format')}")
+
+    classes = metadata.get("classes") or default_classes
+    model = models.get(metadata["architecture"], num_classes=len(classes))
+    assign_state_dict(model, state_dict)
+    return model.to(device), classes
+
+
+def _measure_load(path, kind, queue):
+    # Eseguito in un processo separato per misurare la memoria di picco del solo caricamento
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+
+    if kind == "surface":
+        from surface_analyzer import SurfaceAnalyzer
+
+        model = SurfaceAnalyzer(model_path=path)
+        loaded = model.model is not None
+        sample = np.full((640, 640, 3), 127, dtype=np.uint8)
+        run = lambda: model._analyze_image(sample)
+    else:
+        from operational_optimizer import OperationalOptimizer
+
+        model = OperationalOptimizer()
+        loaded = model.load_model(path)
+        run = lambda: model.predict({"location_size": 100})
+
+    load_seconds = time.perf_counter() - start
+
+    # Prima inferenza: con mmap le pagine dei pesi vengono lette qui
+    start = time.perf_counter()
+    run()
+    first_inference_seconds = time.perf_counter() - start
+
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put({
+        "loaded": loaded,
+        "load_seconds": load_seconds,
+        "first_inference_seconds": first_inference_seconds,
+        # ru_maxrss è in KB su Linux
+        "peak_rss_increase_mb": (rss_after - rss_before) / 1024,
+    })
+
+
+def benchmark(paths, kind="optimizer", repeat=5):
+    """
+    Confronta tempo di caricamento e memoria di picco di più checkpoint,
+    ogni misura in un processo nuovo per simulare un avvio a freddo
+
+    Args:
+        paths: Percorsi dei checkpoint da confrontare
+        kind: "optimizer" per OperationalOptimizer, "surface" per SurfaceAnalyzer
+        repeat: Numero di ripetizioni per checkpoint
+
+    Returns:
+        Dizionario percorso -> statistiche
+    """
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for path in paths:
+        runs = []
+        for _ in range(repeat):
+            queue = context.Queue()
+            process = context.Process(target=_measure_load, args=(path, kind, queue))
+            process.start()
+            runs.append(queue.get())
+            process.join()
+
+        results[path] = {
+            "size_mb": os.path.getsize(path) / (1024 * 1024),
+            "loaded": all(r["loaded"] for r in runs),
+            "load_seconds_median": float(np.median([r["load_seconds"] for r in runs])),
+            "first_inference_seconds_median": float(np.median([r["first_inference_seconds"] for r in runs])),
+            "peak_rss_increase_mb_median": float(np.median([r["peak_rss_increase_mb"] for r in runs])),
+        }
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gestione dei checkpoint safetensors di CleanAI")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    convert_optimizer = subparsers.add_parser("convert-optimizer", help="Converte un checkpoint di OperationalOptimizer")
+    convert_optimizer.add_argument("src")
+    convert_optimizer.add_argument("dst")
+
+    convert_surface = subparsers.add_parser("convert-surface", help="Converte un modello di SurfaceAnalyzer")
+    convert_surface.add_argument("src")
+    convert_surface.add_argument("dst")
+    convert_surface.add_argument("--architecture", default="yolo_nas_s")
+    convert_surface.add_argument("--classes", help="Classi separate da virgola")
+
+    bench = subparsers.add_parser("benchmark", help="Confronta i tempi di caricamento dei checkpoint")
+    bench.add_argument("paths", nargs="+")
+    bench.add_argument("--kind", choices=["optimizer", "surface"], default="optimizer")
+    bench.add_argument("--repeat", type=int, default=5)
+
+    args = parser.parse_args()
+
+    if args.command == "convert-optimizer":
+        convert_optimizer_checkpoint(args.src, args.dst)
+    elif args.command == "convert-surface":
+        classes = args.classes.split(",") if args.classes else None
+        convert_surface_checkpoint(args.src, args.dst, args.architecture, classes)
+    else:
+        print(json.dumps(benchmark(args.paths, args.kind, args.repeat), indent=2))
@@ -0,0 +1,539 @@
+# Generatore di carico per il server FastAPI di CleanAI
+# Misura throughput, latenze, errori e tempi delle fasi lato server (header Server-Timing)
+# degli endpoint di main.py, con immagini e insiemi di attività sintetici.
+#
+# Esempi:
+#   python load_test.py --scenario analyze-image --concurrency 8 --duration 30
+#   python load_test.py --scenario mixed --rate 20 --duration 60 --output run.json
+#   python load_test.py --scenario mixed --rate 20 --duration 60 --compare run.json
+#   python load_test.py --scenario analyze-batch --batch-size 16 --accept application/x-msgpack
+#
+# Il server va avviato localmente (python main.py); senza pesi dei modelli
+# SurfaceAnalyzer e OperationalOptimizer lavorano in modalità simulazione.
+
+import argparse
+import json
+import os
+import platform
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import cv2
+import numpy as np
+
+PERCENTILES = [50, 90, 95, 99]
+
+
+def generate_images(count, size, seed):
+    """
+    Genera immagini JPEG sintetiche con superfici pulite e sporche
+
+    Args:
+        count: Numero di immagini
+        size: Lato dell'immagine in pixel
+        seed: Seme per la riproducibilità
+
+    Returns:
+        Lista di immagini codificate in JPEG (bytes)
+    """
+    rng = np.random.default_rng(seed)
+    images = []
+    for i in range(count):
+        # Superficie uniforme con leggero rumore
+        base = rng.integers(90, 200)
+        image = np.full((size, size, 3), base, dtype=np.uint8)
+        noise = rng.normal(0, 4, image.shape)
+        image = np.clip(image + noise, 0, 255).astype(np.uint8)
+
+        # Metà delle immagini con macchie di sporco
+        if i % 2 == 1:
+            for _ in range(rng.integers(3, 12)):
+                center = (int(rng.integers(0, size)), int(rng.integers(0, size)))
+                radius = int(rng.integers(size // 40 + 1, size // 8 + 2))
+                color = tuple(int(c) for c in rng.integers(0, 80, 3))
+                cv2.circle(image, center, radius, color, -1)
+
+        ok, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        if ok:
+            images.append(encoded.tobytes())
+    return images
+
+
+def generate_task_sets(count, tasks_per_set, seed):
+    """
+    Genera insiemi di attività sintetici per l'ottimizzazione della pianificazione
+
+    Args:
+        count: Numero di insiemi
+        tasks_per_set: Attività per insieme
+        seed: Seme per la riproducibilità
+
+    Returns:
+        Lista di payload JSON (bytes)
+    """
+    rng = random.Random(seed)
+    start_date = datetime(2024, 1, 1)
+    payloads = []
+    for _ in range(count):
+        tasks = []
+        for _ in range(tasks_per_set):
+            tasks.append({
+                "id": str(uuid.UUID(int=rng.getrandbits(128))),
+                "location_id": f"loc-{rng.randint(1, 20)}",
+                "scheduled_at": (start_date + timedelta(hours=rng.randint(0, 24 * 7))).isoformat(),
+                "location_size": rng.randint(20, 500),
+                "priority": rng.choice(["low", "medium", "high", "urgent"]),
+                "task_type": rng.choice(["regular", "deep", "sanitization"]),
+                "days_since_last_cleaned": rng.randint(0, 14),
+                "foot_traffic": rng.randint(0, 100),
+                "humidity": rng.randint(30, 80),
+                "temperature": rng.randint(16, 30),
+                "dirt_level": round(rng.random(), 2),
+            })
+        body = {
+            "tasks": tasks,
+            "staff_count": rng.randint(2, 8),
+            "start_date": start_date.isoformat(),
+            "end_date": (start_date + timedelta(days=6)).isoformat(),
+        }
+        payloads.append(json.dumps(body).encode("utf-8"))
+    return payloads
+
+
+def encode_multipart(field, files, content_type="image/jpeg"):
+    """
+    Codifica uno o più file come corpo multipart/form-data
+
+    Args:
+        field: Nome del campo del form
+        files: Lista di tuple (nome file, contenuto)
+
+    Returns:
+        Tupla (corpo, content-type)
+    """
+    boundary = uuid.uuid4().hex
+    parts = []
+    for filename, content in files:
+        head = (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            f"Content-Type: {content_type}\r\n\r\n"
+        ).encode("utf-8")
+        parts.append(head + content + b"\r\n")
+    tail = f"--{boundary}--\r\n".encode("utf-8")
+    return b"".join(parts) + tail, f"multipart/form-data; boundary={boundary}"
+
+
+def parse_server_timing(header):
+    """
+    Estrae i tempi delle fasi dall'header Server-Timing
+
+    Args:
+        header: Valore dell'header (es. "decode;dur=1.2, analyze;dur=30.5")
+
+    Returns:
+        Dizionario fase -> millisecondi
+    """
+    timings = {}
+    if not header:
+        return timings
+    for entry in header.split(","):
+        parts = [p.strip() for p in entry.split(";")]
+        name = parts[0]
+        for param in parts[1:]:
+            if param.startswith("dur="):
+                try:
+                    timings[name] = float(param[4:])
+                except ValueError:
+                    pass
+    return timings
+
+
+class Scenario:
+    """
+    Richiesta da inviare ripetutamente, con payload sintetici pre-generati
+    in modo che la generazione non pesi sulle misure
+    """
+
+    def __init__(self, name, path, payloads, accept=None):
+        self.name = name
+        self.path = path
+        self.payloads = payloads
+        self.accept = accept
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def next_request(self, base_url):
+        with self._lock:
+            index = self._counter % len(self.payloads)
+            self._counter += 1
+        body, content_type = self.payloads[index]
+        headers = {"Content-Type": content_type}
+        if self.accept:
+            headers["Accept"] = self.accept
+        return urllib.request.Request(
+            base_url + self.path,
+            data=body,
+            method="POST",
+            headers=headers,
+        )
+
+
+def build_scenarios(args):
+    """
+    Costruisce gli scenari di carico richiesti
+
+    Returns:
+        Lista di scenari
+    """
+    scenarios = []
+    names = ["analyze-image", "optimization-suggestions"] if args.scenario == "mixed" else [args.scenario]
+
+    if "analyze-image" in names:
+        images = generate_images(args.payloads, args.image_size, args.seed)
+        payloads = [encode_multipart("file", [(f"synthetic_{i}.jpg", img)]) for i, img in enumerate(images)]
+        scenarios.append(Scenario("analyze-image", "/analyze-image", payloads))
+
+    if "analyze-batch" in names:
+        images = generate_images(args.payloads, args.image_size, args.seed)
+        payloads = []
+        for i in range(args.payloads):
+            batch = [(f"synthetic_{i}_{j}.jpg", images[(i + j) % len(images)]) for j in range(args.batch_size)]
+            payloads.append(encode_multipart("files", batch))
+        scenarios.append(Scenario("analyze-batch", "/analyze-batch", payloads, args.accept))
+
+    if "optimization-suggestions" in names:
+        task_sets = generate_task_sets(args.payloads, args.tasks_per_request, args.seed)
+        payloads = [(body, "application/json") for body in task_sets]
+        scenarios.append(Scenario("optimization-suggestions", "/optimization-suggestions", payloads, args.accept))
+
+    return scenarios
+
+
+class Recorder:
+    """
+    Raccoglie i risultati delle singole richieste in modo thread-safe
+    """
+
+    def __init__(self):
+        self.samples = []
+        self._lock = threading.Lock()
+
+    def add(self, sample):
+        with self._lock:
+            self.samples.append(sample)
+
+
+def send_request(scenario, base_url, timeout, recorder, intended_start=None, record=True):
+    """
+    Invia una richiesta e registra latenza, esito e tempi lato server
+
+    Args:
+        intended_start: Istante di partenza previsto (carico open-loop);
+            la latenza è misurata da qui per non nascondere le code
+    """
+    request = scenario.next_request(base_url)
+    start = time.perf_counter()
+    status_code = None
+    error = None
+    timings = {}
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            status_code = response.status
+            timings = parse_server_timing(response.headers.get("Server-Timing"))
+    except urllib.error.HTTPError as e:
+        status_code = e.code
+        error = f"HTTP {e.code}"
+        timings = parse_server_timing(e.headers.get("Server-Timing") if e.headers else None)
+    except Exception as e:
+        error = type(e).__name__
+
+    end = time.perf_counter()
+    if record:
+        recorder.add({
+            "scenario": scenario.name,
+            "latency_ms": (end - (intended_start or start)) * 1000,
+            "service_ms": (end - start) * 1000,
+            "status": status_code,
+            "error": error,
+            "timings": timings,
+        })
+
+
+def run_closed_loop(scenarios, args, recorder):
+    """
+    Carico a concorrenza fissa: ogni worker invia la richiesta successiva
+    appena riceve la risposta
+    """
+    warmup_end = time.perf_counter() + args.warmup
+    deadline = warmup_end + args.duration
+    stop = threading.Event()
+
+    def worker(worker_id):
+        i = worker_id
+        while not stop.is_set():
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            scenario = scenarios[i % len(scenarios)]
+            i += 1
+            send_request(scenario, args.url, args.timeout, recorder, record=now >= warmup_end)
+
+    threads = [threading.Thread(target=worker, args=(w,), daemon=True) for w in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    try:
+        for t in threads:
+            t.join()
+    except KeyboardInterrupt:
+        stop.set()
+    return warmup_end, deadline
+
+
+def run_open_loop(scenarios, args, recorder):
+    """
+    Carico a tasso di arrivo fisso (processo di Poisson), indipendente
+    dai tempi di risposta del server
+    """
+    rng = random.Random(args.seed)
+    start = time.perf_counter()
+    warmup_end = start + args.warmup
+    deadline = warmup_end + args.duration
+    next_arrival = start
+    i = 0
+
+    with ThreadPoolExecutor(max_workers=args.max_in_flight) as pool:
+        try:
+            while next_arrival < deadline:
+                delay = next_arrival - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                scenario = scenarios[i % len(scenarios)]
+                i += 1
+                pool.submit(send_request, scenario, args.url, args.timeout, recorder,
+                            next_arrival, next_arrival >= warmup_end)
+                next_arrival += rng.expovariate(args.rate)
+        except KeyboardInterrupt:
+            pool.shutdown(wait=False, cancel_futures=True)
+    return warmup_end, deadline
+
+
+def percentile(sorted_values, p):
+    """
+    Percentile con interpolazione lineare su una lista già ordinata
+    """
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * p / 100
+    lower = int(k)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (k - lower)
+
+
+def summarize(samples, window):
+    """
+    Riassume un insieme di campioni
+
+    Args:
+        samples: Campioni registrati
+        window: Durata della finestra di misura in secondi
+
+    Returns:
+        Dizionario con RPS, percentili di latenza, errori e tempi delle fasi
+    """
+    latencies = sorted(s["latency_ms"] for s in samples)
+    errors = [s for s in samples if s["error"]]
+    successes = len(samples) - len(errors)
+
+    error_breakdown = {}
+    for s in errors:
+        error_breakdown[s["error"]] = error_breakdown.get(s["error"], 0) + 1
+
+    stage_values = {}
+    for s in samples:
+        if s["error"]:
+            continue
+        for stage, value in s["timings"].items():
+            stage_values.setdefault(stage, []).append(value)
+
+    server_stages = {}
+    for stage, values in stage_values.items():
+        values.sort()
+        server_stages[stage] = {
+            "mean_ms": sum(values) / len(values),
+            "p50_ms": percentile(values, 50),
+            "p95_ms": percentile(values, 95),
+        }
+
+    return {
+        "requests": len(samples),
+        "successes": successes,
+        "errors": len(errors),
+        "error_rate": len(errors) / len(samples) if samples else 0.0,
+        "error_breakdown": error_breakdown,
+        "achieved_rps": successes / window if window > 0 else 0.0,
+        "latency_ms": {
+            "mean": sum(latencies) / len(latencies) if latencies else None,
+            **{f"p{p}": percentile(latencies, p) for p in PERCENTILES},
+            "max": latencies[-1] if latencies else None,
+        },
+        "server_stages": server_stages,
+    }
+
+
+def build_report(args, recorder, window_start, window_end):
+    """
+    Costruisce il report completo della prova, con la configurazione usata
+    per rendere confrontabili prove diverse
+    """
+    samples = recorder.samples
+    window = window_end - window_start
+
+    by_scenario = {}
+    for s in samples:
+        by_scenario.setdefault(s["scenario"], []).append(s)
+
+    return {
+        "timestamp": datetime.now().isoformat(),
+        "config": {
+            "url": args.url,
+            "scenario": args.scenario,
+            "mode": "open-loop" if args.rate else "closed-loop",
+            "concurrency": None if args.rate else args.concurrency,
+            "rate": args.rate,
+            "duration": args.duration,
+            "warmup": args.warmup,
+            "image_size": args.image_size,
+            "tasks_per_request": args.tasks_per_request,
+            "batch_size": args.batch_size,
+            "accept": args.accept,
+            "payloads": args.payloads,
+            "seed": args.seed,
+        },
+        "environment": {
+            "hostname": platform.node(),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+            "server": fetch_server_info(args.url, args.timeout),
+        },
+        "overall": summarize(samples, window),
+        "scenarios": {name: summarize(items, window) for name, items in by_scenario.items()},
+    }
+
+
+def fetch_server_info(base_url, timeout):
+    try:
+        with urllib.request.urlopen(base_url + "/health", timeout=timeout) as response:
+            return json.loads(response.read())
+    except Exception as e:
+        return {"error": str(e)}
+
+
+def _format_ms(value):
+    return "-" if value is None else f"{value:.1f}"
+
+
+def print_report(report, baseline=None):
+    """
+    Stampa il report in forma tabellare, con le variazioni rispetto
+    a una prova di riferimento se fornita
+    """
+    config = report["config"]
+    load = f"rate={config['rate']}/s" if config["rate"] else f"concurrency={config['concurrency']}"
+    print(f"\nCleanAI load test - {config['scenario']} ({config['mode']}, {load}, {config['duration']}s)")
+
+    sections = [("overall", report["overall"])] + sorted(report["scenarios"].items())
+    for name, summary in sections:
+        latency = summary["latency_ms"]
+        print(f"\n[{name}]")
+        print(f"  richieste: {summary['requests']}  errori: {summary['errors']} "
+              f"({summary['error_rate'] * 100:.2f}%)  RPS: {summary['achieved_rps']:.2f}")
+        print("  latenza ms: " + "  ".join(
+            f"{key}={_format_ms(latency[key])}" for key in ["mean"] + [f"p{p}" for p in PERCENTILES] + ["max"]))
+        if summary["error_breakdown"]:
+            print("  errori: " + ", ".join(f"{k}={v}" for k, v in summary["error_breakdown"].items()))
+        for stage, values in summary["server_stages"].items():
+            print(f"  server {stage}: mean={_format_ms(values['mean_ms'])} p95={_format_ms(values['p95_ms'])}")
+
+        if baseline is not None:
+            base = baseline["overall"] if name == "overall" else baseline["scenarios"].get(name)
+            if base:
+                print_comparison(summary, base)
+
+
+def print_comparison(current, base):
+    def delta(new, old):
+        if new is None or old in (None, 0):
+            return "-"
+        return f"{(new - old) / old * 100:+.1f}%"
+
+    print(f"  vs riferimento: RPS {delta(current['achieved_rps'], base['achieved_rps'])}  "
+          f"p50 {delta(current['latency_ms']['p50'], base['latency_ms']['p50'])}  "
+          f"p99 {delta(current['latency_ms']['p99'], base['latency_ms']['p99'])}  "
+          f"errori {current['error_rate'] * 100:.2f}% (era {base['error_rate'] * 100:.2f}%)")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generatore di carico per il server FastAPI di CleanAI")
+    parser.add_argument("--url", default=os.environ.get("CLEANAI_API_URL", "http://localhost:8000"),
+                        help="URL base del server")
+    parser.add_argument("--scenario", default="mixed",
+                        choices=["analyze-image", "analyze-batch", "optimization-suggestions", "mixed"],
+                        help="Endpoint da sollecitare")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="Numero di client concorrenti (carico closed-loop)")
+    parser.add_argument("--rate", type=float, default=None,
+                        help="Richieste al secondo (carico open-loop); se indicato ignora --concurrency")
+    parser.add_argument("--max-in-flight", type=int, default=256,
+                        help="Massimo di richieste contemporanee in open-loop")
+    parser.add_argument("--duration", type=float, default=30, help="Durata della misura in secondi")
+    parser.add_argument("--warmup", type=float, default=5, help="Secondi di riscaldamento non misurati")
+    parser.add_argument("--timeout", type=float, default=30, help="Timeout della singola richiesta in secondi")
+    parser.add_argument("--image-size", type=int, default=640, help="Lato delle immagini sintetiche")
+    parser.add_argument("--batch-size", type=int, default=8, help="Immagini per richiesta di analyze-batch")
+    parser.add_argument("--accept", default=None,
+                        help="Header Accept per gli endpoint con risposta negoziata (es. application/x-msgpack)")
+    parser.add_argument("--tasks-per-request", type=int, default=50, help="Attività per richiesta di pianificazione")
+    parser.add_argument("--payloads", type=int, default=32, help="Numero di payload sintetici distinti")
+    parser.add_argument("--seed", type=int, default=42, help="Seme per payload e arrivi")
+    parser.add_argument("--output", help="File JSON dove salvare il report")
+    parser.add_argument("--compare", help="Report JSON di una prova precedente da confrontare")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    args.url = args.url.rstrip("/")
+
+    scenarios = build_scenarios(args)
+    recorder = Recorder()
+
+    if args.rate:
+        window_start, window_end = run_open_loop(scenarios, args, recorder)
+    else:
+        window_start, window_end = run_closed_loop(scenarios, args, recorder)
+
+    report = build_report(args, recorder, window_start, window_end)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    print_report(report, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nReport salvato in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
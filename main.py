@@ -1,12 +1,32 @@
 # Configurazione del server FastAPI per CleanAI
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, status, Request, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordBearer
-from typing import List, Optional
+from pydantic import BaseModel
+from contextlib import contextmanager
+from functools import partial
+from typing import Any, Dict, List, Optional
 import os
+import json
+import time
 import uvicorn
 import logging
 
+from analysis_pipeline import AnalysisPipeline
+from model_registry import (
+    ModelRegistry,
+    load_surface_analyzer,
+    warmup_surface_analyzer,
+    load_operational_optimizer,
+    warmup_operational_optimizer,
+)
+from prediction_service import PredictionService
+from quality_rollups import QualityRollupStore
+from triage_cascade import TriageCascade
+from whatif_engine import WhatIfEngine, create_pool as create_whatif_pool
+import response_encoding
+
 # Configurazione logging
 logging.basicConfig(
     level=logging.INFO,
@@ -28,11 +48,147 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing"],
 )
 
 # Configurazione autenticazione OAuth2
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# Registri dei modelli, caricati al primo utilizzo e sostituibili a caldo.
+# Senza pesi disponibili entrambi i modelli lavorano in modalità simulazione.
+# OPTIMIZER_MODEL_PATH può indicare anche l'index.json dei modelli per sede
+# scritto da training_orchestrator.py.
+keep_previous_models = os.environ.get("KEEP_PREVIOUS_MODELS", "false").lower() == "true"
+
+# Cascata di triage prima del modello neurale, condivisa tra le versioni del modello
+surface_triage = None
+if os.environ.get("TRIAGE_ENABLED", "false").lower() == "true":
+    surface_triage = TriageCascade(
+        thresholds=json.loads(os.environ.get("TRIAGE_THRESHOLDS", "{}")),
+        audit_rate=float(os.environ.get("TRIAGE_AUDIT_RATE", "0.05")),
+    )
+
+model_registries = {
+    "surface_analyzer": ModelRegistry(
+        "surface_analyzer",
+        partial(load_surface_analyzer, triage=surface_triage),
+        warmup_surface_analyzer,
+        initial_path=os.environ.get("SURFACE_MODEL_PATH"),
+        keep_previous=keep_previous_models,
+    ),
+    "operational_optimizer": ModelRegistry(
+        "operational_optimizer",
+        load_operational_optimizer,
+        warmup_operational_optimizer,
+        initial_path=os.environ.get("OPTIMIZER_MODEL_PATH"),
+        keep_previous=keep_previous_models,
+    ),
+}
+
+# Predizioni memorizzate per attività e raggruppate tra richieste concorrenti
+prediction_service = PredictionService(
+    model_registries["operational_optimizer"],
+    max_batch_size=int(os.environ.get("PREDICTION_MAX_BATCH_SIZE", "1024")),
+    max_wait_ms=float(os.environ.get("PREDICTION_MAX_WAIT_MS", "5")),
+    cache_size=int(os.environ.get("PREDICTION_CACHE_SIZE", "10000")),
+)
+
+# Pipeline a stadi per l'analisi delle immagini: decodifica e ridimensionamento,
+# inferenza e post-elaborazione si sovrappongono tra richieste diverse
+analysis_pipeline = AnalysisPipeline(
+    decode_workers=int(os.environ.get("PIPELINE_DECODE_WORKERS", str(min(4, os.cpu_count() or 1)))),
+    inference_workers=int(os.environ.get("PIPELINE_INFERENCE_WORKERS", "1")),
+    postprocess_workers=int(os.environ.get("PIPELINE_POSTPROCESS_WORKERS", "2")),
+    queue_size=int(os.environ.get("PIPELINE_QUEUE_SIZE", "16")),
+)
+
+# Processi paralleli per le simulazioni what-if dei siti con molte attività
+whatif_processes = int(os.environ.get("WHATIF_PROCESSES", "1"))
+whatif_pool = create_whatif_pool(whatif_processes) if whatif_processes > 1 else None
+# Limiti di una singola simulazione: campioni e combinazioni operatori x scenari
+whatif_max_samples = int(os.environ.get("WHATIF_MAX_SAMPLES", "20000"))
+whatif_max_combinations = int(os.environ.get("WHATIF_MAX_COMBINATIONS", "40"))
+
+# Righe per blocco nelle risposte MessagePack/Arrow
+response_chunk_rows = int(os.environ.get("RESPONSE_CHUNK_ROWS", response_encoding.DEFAULT_CHUNK_ROWS))
+
+# Aggregati di qualità per i grafici di andamento della dashboard
+quality_rollups = QualityRollupStore(path=os.environ.get("QUALITY_ROLLUPS_PATH"),
+                                     save_interval=float(os.environ.get("QUALITY_ROLLUPS_SAVE_INTERVAL", "5")))
+
+
+def get_model_registry(name: str) -> ModelRegistry:
+    registry = model_registries.get(name)
+    if registry is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Modello {name} non trovato")
+    return registry
+
+
+def require_admin(token: str = Depends(oauth2_scheme)):
+    admin_token = os.environ.get("ADMIN_API_TOKEN")
+    if not admin_token or token != admin_token:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Accesso amministrativo negato")
+
+
+# Tempi delle fasi lato server, esposti nell'header Server-Timing
+@contextmanager
+def stage_timer(request: Request, name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = getattr(request.state, "timings", None)
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + (time.perf_counter() - start) * 1000
+
+
+@app.middleware("http")
+async def server_timing_middleware(request: Request, call_next):
+    request.state.timings = {}
+    start = time.perf_counter()
+    response = await call_next(request)
+    total_ms = (time.perf_counter() - start) * 1000
+    entries = [f"{name};dur={duration:.3f}" for name, duration in request.state.timings.items()]
+    entries.append(f"total;dur={total_ms:.3f}")
+    response.headers["Server-Timing"] = ", ".join(entries)
+    return response
+
+
+class PredictionRequest(BaseModel):
+    tasks: List[Dict[str, Any]]
+
+
+class InvalidatePredictionsRequest(BaseModel):
+    task_ids: Optional[List[str]] = None
+
+
+class WhatIfRequest(BaseModel):
+    tasks: List[Dict[str, Any]]
+    start_date: str
+    end_date: str
+    staff_counts: List[int]
+    scenarios: Optional[Dict[str, Dict[str, float]]] = None
+    samples: int = 1000
+    seed: Optional[int] = None
+
+
+class ModelLoadRequest(BaseModel):
+    path: str
+    version: Optional[str] = None
+    activate: bool = True
+
+
+class QualityReportsRequest(BaseModel):
+    reports: List[Dict[str, Any]]
+
+
+class ScheduleRequest(BaseModel):
+    tasks: List[Dict[str, Any]]
+    staff_count: int = 5
+    start_date: str
+    end_date: str
+
+
 # Endpoint di base
 @app.get("/")
 async def root():
@@ -45,9 +201,77 @@ async def health_check():
 
 # Endpoint per l'analisi visiva delle immagini
 @app.post("/analyze-image")
-async def analyze_image():
-    # Qui verrà implementata l'analisi delle immagini con YOLO-NAS
-    return {"message": "Analisi immagine completata", "quality_score": 0.85}
+def analyze_image(request: Request, file: UploadFile = File(...)):
+    with stage_timer(request, "read"):
+        data = file.file.read()
+
+    # Decodifica, inferenza e post-elaborazione avvengono negli stadi della pipeline
+    with model_registries["surface_analyzer"].acquire() as analyzer:
+        with stage_timer(request, "analyze"):
+            result = analysis_pipeline.analyze(analyzer, data, timings=request.state.timings)
+
+    if result.get("invalid"):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Immagine non valida")
+    if result.get("unusable"):
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=result["error"])
+    if "error" in result:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=result["error"])
+
+    return {
+        "message": "Analisi immagine completata",
+        "quality_score": result["cleanliness_score"],
+        **result,
+    }
+
+# Endpoint per l'analisi di più immagini; con Accept MessagePack o Arrow
+# le rilevazioni sono restituite in forma colonnare e a blocchi
+@app.post("/analyze-batch")
+def analyze_batch(request: Request, files: List[UploadFile] = File(...)):
+    images = []
+    for upload in files:
+        with stage_timer(request, "read"):
+            data = upload.file.read()
+        # Decodificate negli stadi della pipeline: le immagini non valide
+        # sono riportate nella colonna error come gli altri errori per immagine
+        images.append(data)
+
+    with model_registries["surface_analyzer"].acquire() as analyzer:
+        with stage_timer(request, "analyze"):
+            batch = analysis_pipeline.analyze_batch(analyzer, images, timings=request.state.timings)
+
+    media_type = response_encoding.negotiate(request.headers.get("accept"))
+    if media_type == response_encoding.JSON:
+        with stage_timer(request, "serialize"):
+            return response_encoding.batch_to_json(batch)
+
+    columns, metadata = response_encoding.batch_columns(batch)
+    return StreamingResponse(response_encoding.iter_encoded(media_type, columns, metadata, response_chunk_rows),
+                             media_type=media_type)
+
+# Confronto prima/dopo la pulizia; con mode=regions il modello analizza
+# solo le zone cambiate e un campione di quelle invariate
+@app.post("/compare-before-after")
+def compare_before_after(request: Request, before: UploadFile = File(...), after: UploadFile = File(...),
+                         mode: str = "full"):
+    if mode not in ("full", "regions"):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="mode deve essere full o regions")
+
+    with stage_timer(request, "read"):
+        before_data = before.file.read()
+        after_data = after.file.read()
+
+    with model_registries["surface_analyzer"].acquire() as analyzer:
+        with stage_timer(request, "compare"):
+            result = analyzer.compare_before_after(before_data, after_data, mode=mode)
+
+    if result.get("invalid"):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Immagine non valida")
+    if result.get("unusable"):
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=result["error"])
+    if "error" in result:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=result["error"])
+
+    return result
 
 # Endpoint per l'ottimizzazione operativa
 @app.get("/optimization-suggestions")
@@ -55,6 +279,167 @@ async def get_optimization_suggestions():
     # Qui verranno implementati gli algoritmi di ottimizzazione con PyTorch
     return {"suggestions": ["Aumentare frequenza pulizia in area A", "Ridurre tempo in area B"]}
 
+@app.post("/optimization-suggestions")
+def optimize_schedule(request: Request, body: ScheduleRequest):
+    media_type = response_encoding.negotiate(request.headers.get("accept"))
+    if media_type != response_encoding.JSON:
+        with model_registries["operational_optimizer"].acquire() as optimizer:
+            with stage_timer(request, "optimize"):
+                try:
+                    schedule_df, summary = optimizer.optimize_schedule_frame(
+                        body.tasks, body.staff_count, body.start_date, body.end_date,
+                        predict_fn=prediction_service.predict)
+                except Exception as e:
+                    raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+        columns, metadata = response_encoding.schedule_columns(schedule_df, summary)
+        return StreamingResponse(response_encoding.iter_encoded(media_type, columns, metadata, response_chunk_rows),
+                                 media_type=media_type)
+
+    with model_registries["operational_optimizer"].acquire() as optimizer:
+        with stage_timer(request, "optimize"):
+            result = optimizer.optimize_schedule(body.tasks, body.staff_count, body.start_date, body.end_date,
+                                                 predict_fn=prediction_service.predict)
+
+    if "error" in result:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=result["error"])
+
+    return result
+
+# Predizioni per singole attività: durata stimata, qualità prevista e priorità suggerita
+@app.post("/predict")
+def predict_tasks(request: Request, body: PredictionRequest):
+    with stage_timer(request, "predict"):
+        try:
+            predictions = prediction_service.predict(body.tasks)
+        except Exception as e:
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+    return {
+        "predictions": [
+            {
+                "task_id": task.get("id"),
+                "estimated_duration": float(prediction[0]),
+                "expected_quality": float(prediction[1]),
+                "suggested_priority": float(prediction[2]),
+            }
+            for task, prediction in zip(body.tasks, predictions)
+        ]
+    }
+
+# Simulazione what-if: tasso di completamento e straordinari al variare del personale
+@app.post("/what-if/staffing")
+def simulate_staffing(request: Request, body: WhatIfRequest):
+    if not 1 <= body.samples <= whatif_max_samples:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"samples deve essere tra 1 e {whatif_max_samples}")
+    combinations = len(set(body.staff_counts)) * max(1, len(body.scenarios or {}))
+    if combinations > whatif_max_combinations:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Troppe combinazioni operatori x scenari ({combinations}, massimo {whatif_max_combinations})")
+
+    with model_registries["operational_optimizer"].acquire() as optimizer:
+        engine = WhatIfEngine(optimizer, predict_fn=prediction_service.predict, processes=whatif_processes,
+                              pool=whatif_pool)
+        with stage_timer(request, "simulate"):
+            result = engine.simulate(body.tasks, body.start_date, body.end_date, body.staff_counts,
+                                     scenarios=body.scenarios, num_samples=body.samples, seed=body.seed)
+
+    if "error" in result:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=result["error"])
+
+    return result
+
+@app.get("/predictions/stats")
+def get_prediction_stats():
+    return prediction_service.stats()
+
+@app.post("/admin/predictions/invalidate", dependencies=[Depends(require_admin)])
+def invalidate_predictions(body: InvalidatePredictionsRequest):
+    return {"invalidated": prediction_service.invalidate(body.task_ids)}
+
+# Endpoint per l'andamento della qualità, serviti dagli aggregati precalcolati
+@app.get("/analytics/quality-trends")
+def get_quality_trends(location_id: Optional[str] = None, granularity: str = "day",
+                       start: Optional[str] = None, end: Optional[str] = None):
+    try:
+        return quality_rollups.query(location_id=location_id, granularity=granularity, start=start, end=end)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+# Ingestione dei nuovi report (location_id, quality_score, completed_at, ai_analysis_result)
+@app.post("/analytics/quality-trends/reports", dependencies=[Depends(require_admin)])
+def ingest_quality_reports(body: QualityReportsRequest):
+    try:
+        added = quality_rollups.add_reports(body.reports)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    # Salvataggio raggruppato: più richieste ravvicinate producono una sola scrittura
+    quality_rollups.schedule_save()
+    return {"added": added, "skipped": len(body.reports) - added, **quality_rollups.stats()}
+
+@app.get("/analytics/quality-trends/stats")
+def get_quality_trends_stats():
+    return quality_rollups.stats()
+
+# Utilizzo degli stadi della pipeline di analisi
+@app.get("/pipeline/stats")
+def get_pipeline_stats():
+    return analysis_pipeline.stats()
+
+@app.post("/admin/pipeline/reset", dependencies=[Depends(require_admin)])
+def reset_pipeline_stats():
+    analysis_pipeline.reset_stats()
+    return analysis_pipeline.stats()
+
+# Statistiche della cascata di triage (tasso di salto e calibrazione)
+@app.get("/triage/stats")
+def get_triage_stats():
+    if surface_triage is None:
+        return {"enabled": False}
+    return {"enabled": True, **surface_triage.stats()}
+
+@app.post("/admin/triage/reset", dependencies=[Depends(require_admin)])
+def reset_triage_stats():
+    if surface_triage is not None:
+        surface_triage.reset_stats()
+    return {"enabled": surface_triage is not None}
+
+# Endpoint amministrativi per la gestione delle versioni dei modelli
+@app.get("/admin/models", dependencies=[Depends(require_admin)])
+def list_models():
+    return {name: registry.status() for name, registry in model_registries.items()}
+
+@app.post("/admin/models/{name}/load", status_code=status.HTTP_202_ACCEPTED, dependencies=[Depends(require_admin)])
+def load_model_version(name: str, body: ModelLoadRequest):
+    registry = get_model_registry(name)
+    if not os.path.exists(body.path):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"File {body.path} non trovato")
+    try:
+        version = registry.load_async(body.path, version=body.version, activate=body.activate)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    return {"name": name, "version": version, "state": "loading"}
+
+@app.post("/admin/models/{name}/activate/{version}", dependencies=[Depends(require_admin)])
+def activate_model_version(name: str, version: str):
+    registry = get_model_registry(name)
+    try:
+        registry.activate(version)
+    except KeyError as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    return registry.status()
+
+@app.post("/admin/models/{name}/rollback", dependencies=[Depends(require_admin)])
+def rollback_model_version(name: str):
+    registry = get_model_registry(name)
+    try:
+        version = registry.rollback()
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    return {"name": name, "version": version, **registry.status()}
+
 # Avvio del server se eseguito direttamente
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8000))
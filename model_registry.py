@@ -0,0 +1,391 @@
+# Registro dei modelli con sostituzione a caldo
+# Carica una nuova versione in background, la valida con un passaggio di riscaldamento,
+# la attiva atomicamente per le nuove richieste e libera la versione precedente
+# quando le richieste in corso su di essa sono terminate.
+
+import gc
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import torch
+
+from surface_analyzer import SurfaceAnalyzer
+from operational_optimizer import OperationalOptimizer
+
+# Stati di una versione
+LOADING = "loading"
+READY = "ready"
+ACTIVE = "active"
+DRAINING = "draining"
+STANDBY = "standby"
+RETIRED = "retired"
+FAILED = "failed"
+
+
+class ModelVersion:
+    """
+    Versione di un modello gestita dal registro
+    """
+
+    def __init__(self, version, path):
+        self.version = version
+        self.path = path
+        self.instance = None
+        self.state = LOADING
+        self.error = None
+        self.in_flight = 0
+        self.created_at = datetime.now()
+        self.loaded_at = None
+        self.activated_at = None
+        self.load_seconds = None
+        self.warmup_seconds = None
+        # Tentativi di caricamento (più di uno solo per il caricamento iniziale ripetuto)
+        self.attempts = 0
+
+    def to_dict(self):
+        return {
+            "version": self.version,
+            "path": self.path,
+            "state": self.state,
+            "error": self.error,
+            "in_flight": self.in_flight,
+            "created_at": self.created_at.isoformat(),
+            "loaded_at": self.loaded_at.isoformat() if self.loaded_at else None,
+            "activated_at": self.activated_at.isoformat() if self.activated_at else None,
+            "load_seconds": self.load_seconds,
+            "warmup_seconds": self.warmup_seconds,
+            "attempts": self.attempts,
+        }
+
+
+class ModelRegistry:
+    """
+    Gestisce le versioni di un modello e lo scambio a caldo tra di esse
+    """
+
+    def __init__(self, name, loader, warmup, initial_path=None, keep_previous=False, drain_timeout=300,
+                 retry_seconds=30, max_retry_seconds=600):
+        """
+        Inizializza il registro
+
+        Args:
+            name: Nome del modello (es. "surface_analyzer")
+            loader: Funzione path -> istanza del modello
+            warmup: Funzione istanza -> None, solleva un'eccezione se il modello non è valido
+            initial_path: Percorso del modello da caricare al primo utilizzo
+            keep_previous: Se True la versione precedente resta in memoria per un rollback immediato
+            drain_timeout: Secondi massimi di attesa delle richieste in corso prima di liberare una versione
+            retry_seconds: Attesa iniziale prima di ritentare un primo caricamento fallito
+            max_retry_seconds: Attesa massima tra i tentativi (raddoppia a ogni fallimento)
+        """
+        self.name = name
+        self.loader = loader
+        self.warmup = warmup
+        self.initial_path = initial_path
+        self.keep_previous = keep_previous
+        self.drain_timeout = drain_timeout
+
+        self.versions = {}
+        self.active = None
+        self.previous = None
+        self._lock = threading.Condition()
+        self._initial_lock = threading.Lock()
+
+        # Esito del primo caricamento: dopo un fallimento le richieste non lo ripetono,
+        # il nuovo tentativo avviene in background con attesa crescente
+        self.retry_seconds = retry_seconds
+        self.max_retry_seconds = max_retry_seconds
+        self._initial_error = None
+        # Versione del caricamento iniziale, riusata dai nuovi tentativi
+        self._initial_version = None
+        self._retry_delay = retry_seconds
+        self._next_retry = 0.0
+        self._retrying = False
+
+    @contextmanager
+    def acquire(self):
+        """
+        Restituisce l'istanza attiva per la durata di una richiesta.
+        La versione non viene liberata finché la richiesta non termina.
+        """
+        with self.acquire_version() as version:
+            yield version.instance
+
+    @contextmanager
+    def acquire_version(self):
+        """
+        Come acquire, ma restituisce la ModelVersion (identificativo e istanza)
+        """
+        if self.active is None:
+            self._load_initial()
+
+        with self._lock:
+            version = self.active
+            if version is None:
+                raise RuntimeError(f"Nessuna versione attiva per {self.name}")
+            version.in_flight += 1
+
+        try:
+            yield version
+        finally:
+            with self._lock:
+                version.in_flight -= 1
+                self._lock.notify_all()
+
+    def _load_initial(self):
+        # Il primo caricamento è sincrono: non c'è ancora nessuna versione da servire
+        with self._initial_lock:
+            if self.active is not None:
+                return
+            if self._initial_error is None:
+                version = self._new_version(self.initial_path)
+                self._initial_version = version
+                self._load(version, activate=True)
+                if version.state != FAILED:
+                    return
+                self._initial_failed(version.error)
+            elif not self._retrying and time.monotonic() >= self._next_retry:
+                self._retrying = True
+                threading.Thread(target=self._retry_initial, daemon=True, name=f"{self.name}-retry").start()
+            error = self._initial_error
+
+        raise RuntimeError(f"Caricamento di {self.name} fallito: {error}")
+
+    def _initial_failed(self, error):
+        # Da chiamare con _initial_lock acquisito
+        self._initial_error = error
+        self._next_retry = time.monotonic() + self._retry_delay
+        print(f"{self.name}: nuovo tentativo di caricamento tra {self._retry_delay:.0f}s")
+        self._retry_delay = min(self._retry_delay * 2, self.max_retry_seconds)
+
+    def _retry_initial(self):
+        # Stessa voce del primo tentativo: i fallimenti ripetuti non si accumulano in versions
+        version = self._initial_version
+        version.state = LOADING
+        version.error = None
+        self._load(version, activate=True)
+        with self._initial_lock:
+            self._retrying = False
+            if version.state == FAILED:
+                self._initial_failed(version.error)
+            else:
+                self._initial_error = None
+                self._retry_delay = self.retry_seconds
+
+    def _new_version(self, path, version=None):
+        version = version or f"{datetime.now():%Y%m%d%H%M%S}-{uuid.uuid4().hex[:6]}"
+        with self._lock:
+            if version in self.versions:
+                raise ValueError(f"Versione {version} già presente per {self.name}")
+            entry = ModelVersion(version, path)
+            self.versions[version] = entry
+        return entry
+
+    def load_async(self, path, version=None, activate=True):
+        """
+        Carica e valida una nuova versione in un thread separato
+
+        Args:
+            path: Percorso del modello
+            version: Identificativo della versione (generato se omesso)
+            activate: Se True la versione viene attivata appena validata
+
+        Returns:
+            Identificativo della versione in caricamento
+        """
+        entry = self._new_version(path, version)
+        thread = threading.Thread(target=self._load, args=(entry, activate), daemon=True,
+                                  name=f"{self.name}-load-{entry.version}")
+        thread.start()
+        return entry.version
+
+    def _load(self, entry, activate):
+        entry.attempts += 1
+        try:
+            start = time.perf_counter()
+            instance = self.loader(entry.path)
+            entry.load_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            self.warmup(instance)
+            entry.warmup_seconds = time.perf_counter() - start
+
+            entry.instance = instance
+            entry.loaded_at = datetime.now()
+            entry.state = READY
+            print(f"{self.name}: versione {entry.version} caricata in {entry.load_seconds:.2f}s "
+                  f"(riscaldamento {entry.warmup_seconds:.2f}s)")
+        except Exception as e:
+            entry.state = FAILED
+            entry.error = str(e)
+            entry.instance = None
+            print(f"{self.name}: errore nel caricamento della versione {entry.version}: {e}")
+            return
+
+        if activate:
+            self.activate(entry.version)
+
+    def activate(self, version):
+        """
+        Attiva una versione già caricata. Le nuove richieste usano subito la nuova
+        versione, quella precedente viene liberata al termine delle richieste in corso.
+
+        Args:
+            version: Identificativo della versione
+        """
+        with self._lock:
+            entry = self.versions.get(version)
+            if entry is None:
+                raise KeyError(f"Versione {version} non trovata per {self.name}")
+            if entry.state not in (READY, STANDBY):
+                raise ValueError(f"La versione {version} non è attivabile (stato: {entry.state})")
+
+            old = self.active
+            entry.state = ACTIVE
+            entry.activated_at = datetime.now()
+            self.active = entry
+
+            stale = None
+            if old is not None and old is not entry:
+                # Una versione in standby non più precedente non serve per il rollback
+                if self.previous is not None and self.previous is not entry and self.previous.state == STANDBY:
+                    stale = self._retire(self.previous)
+                old.state = DRAINING
+                self.previous = old
+
+        if stale is not None:
+            stale = None
+            self._free_memory()
+
+        print(f"{self.name}: versione {version} attiva")
+
+        if old is not None and old is not entry:
+            threading.Thread(target=self._drain, args=(old,), daemon=True,
+                             name=f"{self.name}-drain-{old.version}").start()
+
+    def _drain(self, entry):
+        deadline = time.monotonic() + self.drain_timeout
+        with self._lock:
+            while entry.in_flight > 0 and time.monotonic() < deadline:
+                self._lock.wait(timeout=1.0)
+
+            # La versione potrebbe essere stata riattivata da un rollback nel frattempo
+            if entry.state != DRAINING:
+                return
+
+            if self.keep_previous and entry is self.previous:
+                entry.state = STANDBY
+                print(f"{self.name}: versione {entry.version} in standby")
+                return
+
+            self._retire(entry)
+
+        self._free_memory()
+
+    def _retire(self, entry):
+        # Da chiamare con il lock acquisito; la memoria va liberata dopo averlo rilasciato
+        entry.state = RETIRED
+        instance = entry.instance
+        entry.instance = None
+        print(f"{self.name}: versione {entry.version} liberata")
+        return instance
+
+    def _free_memory(self):
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def rollback(self):
+        """
+        Torna alla versione attiva in precedenza. Se è ancora in memoria viene
+        riattivata subito, altrimenti viene ricaricata in background.
+
+        Returns:
+            Identificativo della versione riattivata o in caricamento
+        """
+        with self._lock:
+            previous = self.previous
+            if previous is None:
+                raise ValueError(f"Nessuna versione precedente per {self.name}")
+            resident = previous.instance is not None and previous.state in (DRAINING, STANDBY)
+            if resident:
+                previous.state = READY
+
+        if resident:
+            self.activate(previous.version)
+            return previous.version
+
+        return self.load_async(previous.path)
+
+    def status(self):
+        """
+        Restituisce lo stato del registro e di tutte le versioni
+        """
+        with self._lock:
+            return {
+                "name": self.name,
+                "active": self.active.version if self.active else None,
+                "previous": self.previous.version if self.previous else None,
+                "versions": [v.to_dict() for v in self.versions.values()],
+            }
+
+
+def load_surface_analyzer(path, triage=None):
+    """
+    Crea un SurfaceAnalyzer per il registro.
+    Se era richiesto un modello ma è scattata la modalità simulazione, il caricamento è fallito.
+    """
+    analyzer = SurfaceAnalyzer(model_path=path, triage=triage)
+    if path and analyzer.model is None:
+        raise RuntimeError(f"Impossibile caricare il modello da {path}")
+    return analyzer
+
+
+def warmup_surface_analyzer(analyzer):
+    """
+    Esegue un passaggio di inferenza su un'immagine sintetica, senza passare dalla cascata di triage
+    """
+    image = np.full((640, 640, 3), 127, dtype=np.uint8)
+    result = analyzer._analyze_image(image)
+    if "error" in result:
+        raise RuntimeError(f"Riscaldamento fallito: {result['error']}")
+
+
+def load_operational_optimizer(path):
+    """
+    Crea un OperationalOptimizer per il registro
+    """
+    optimizer = OperationalOptimizer()
+    if path and not optimizer.load_model(path):
+        raise RuntimeError(f"Impossibile caricare il modello da {path}")
+    return optimizer
+
+
+def warmup_operational_optimizer(optimizer):
+    """
+    Esegue il passaggio reale del modello (scaler e rete) su un'attività sintetica.
+    Non usa predict, che in caso di errore ripiega sulla simulazione.
+    Le eccezioni si propagano e fanno fallire la versione.
+    """
+    if optimizer.model is None:
+        # Nessun modello richiesto: modalità simulazione
+        return
+
+    task = pd.DataFrame([{"location_size": 100, "priority": "medium", "task_type": "regular",
+                          "scheduled_at": datetime.now().isoformat()}])
+    features = optimizer._extract_features(task)
+    if features is None:
+        raise RuntimeError("Riscaldamento fallito: estrazione delle feature non riuscita")
+
+    # Anche i modelli per sede di un indice devono essere validi
+    for name, candidate in [("globale", optimizer)] + list(optimizer.routed_models.items()):
+        predictions = np.asarray(candidate._forward(candidate.scale_features(features)))
+        expected = (len(features), candidate.model.output_size)
+        if predictions.shape != expected or not np.all(np.isfinite(predictions)):
+            raise RuntimeError(f"Riscaldamento fallito per il modello {name}: predizione non valida "
+                               f"(forma {predictions.shape}, attesa {expected})")
@@ -11,7 +11,8 @@ from sklearn.model_selection import train_test_split
 import matplotlib.pyplot as plt
 import os
 import json
-from datetime import datetime, timedelta
+from datetime import datetime
+from checkpoint_format import is_safetensors_checkpoint, load_optimizer_checkpoint, save_optimizer_checkpoint, assign_state_dict
 
 class OperationalOptimizer:
     """
@@ -34,6 +35,11 @@ class OperationalOptimizer:
         self.model = None
         self.scaler = StandardScaler()
         
+        # Modelli per sede o cliente caricati da un indice (vedi training_orchestrator.py)
+        self.routed_models = {}
+        self.route_field = None
+        self.index_version = None
+        
         # Carica il modello se specificato
         if model_path and os.path.exists(model_path):
             self.load_model(model_path)
@@ -46,37 +52,108 @@ class OperationalOptimizer:
         
         Args:
             model_path: Percorso al modello
+            
+        Returns:
+            True se il modello è stato caricato, False se è stato usato il modello di default
         """
+        if model_path.endswith('.json'):
+            return self.load_model_index(model_path)
+        
         try:
-            checkpoint = torch.load(model_path, map_location=self.device)
+            if is_safetensors_checkpoint(model_path):
+                # Checkpoint safetensors: pesi mappati in memoria, senza copie
+                checkpoint = load_optimizer_checkpoint(model_path, self.device)
+            else:
+                # Checkpoint legacy: contiene anche array NumPy dello scaler, non caricabili
+                # con weights_only=True (il default da PyTorch 2.6). Solo file fidati
+                checkpoint = torch.load(model_path, map_location=self.device, weights_only=False)
             self.model = PredictiveModel(
                 input_size=checkpoint['input_size'],
                 hidden_size=checkpoint['hidden_size'],
                 output_size=checkpoint['output_size']
             )
-            self.model.load_state_dict(checkpoint['model_state_dict'])
+            assign_state_dict(self.model, checkpoint['model_state_dict'])
             self.model.to(self.device)
             self.model.eval()
             
             # Carica anche lo scaler
-            if 'scaler_mean' in checkpoint and 'scaler_scale' in checkpoint:
-                self.scaler.mean_ = checkpoint['scaler_mean']
-                self.scaler.scale_ = checkpoint['scaler_scale']
+            if checkpoint.get('scaler_mean') is not None and checkpoint.get('scaler_scale') is not None:
+                self._restore_scaler(checkpoint['scaler_mean'], checkpoint['scaler_scale'])
             
             print(f"Modello caricato da {model_path}")
+            return True
         except Exception as e:
             print(f"Errore nel caricamento del modello: {e}")
             # Creiamo un modello di default
             self.model = PredictiveModel(input_size=10, hidden_size=20, output_size=3)
             self.model.to(self.device)
             self.model.eval()
+            return False
     
-    def preprocess_data(self, data):
+    def load_model_index(self, index_path, version=None):
+        """
+        Carica i modelli di un indice versionato: il modello globale diventa
+        il modello di questa istanza, gli altri sono usati per le rispettive sedi
+        
+        Args:
+            index_path: Percorso del file index.json
+            version: Versione dell'indice da caricare (di default quella corrente)
+            
+        Returns:
+            True se i modelli sono stati caricati, False altrimenti
+        """
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+            version = version or index['current']
+            entry = index['versions'][version]
+            base_dir = os.path.dirname(os.path.abspath(index_path))
+            
+            routed_models = {}
+            for group, model in entry['models'].items():
+                path = os.path.join(base_dir, model['path'])
+                if group == entry['default']:
+                    if not self.load_model(path):
+                        return False
+                    continue
+                optimizer = OperationalOptimizer()
+                if not optimizer.load_model(path):
+                    print(f"Modello per {group} non caricato: si userà il modello globale")
+                    continue
+                routed_models[group] = optimizer
+            
+            self.routed_models = routed_models
+            self.route_field = entry['group_by']
+            self.index_version = version
+            print(f"Indice {version} caricato: {len(routed_models)} modelli per {self.route_field}")
+            return True
+        except Exception as e:
+            print(f"Errore nel caricamento dell'indice dei modelli: {e}")
+            return False
+    
+    def _restore_scaler(self, mean, scale):
+        """
+        Ripristina lo scaler adattato in fase di addestramento
+        
+        Args:
+            mean: Medie delle feature
+            scale: Deviazioni standard delle feature
+        """
+        self.scaler = StandardScaler()
+        self.scaler.mean_ = np.asarray(mean, dtype=np.float64)
+        self.scaler.scale_ = np.asarray(scale, dtype=np.float64)
+        self.scaler.var_ = self.scaler.scale_ ** 2
+        self.scaler.n_features_in_ = len(self.scaler.mean_)
+        self.scaler.n_samples_seen_ = 0
+    
+    def preprocess_data(self, data, fit=False):
         """
         Preprocessa i dati per l'addestramento o l'inferenza
         
         Args:
             data: DataFrame con i dati delle attività di pulizia
+            fit: Se True adatta lo scaler ai dati (solo in addestramento);
+                in inferenza si usa lo scaler fissato durante l'addestramento
             
         Returns:
             Dati preprocessati
@@ -86,11 +163,27 @@ class OperationalOptimizer:
         
         # Normalizza i dati
         if features is not None:
-            normalized_features = self.scaler.fit_transform(features)
-            return normalized_features
+            if fit:
+                return self.scaler.fit_transform(features)
+            return self.scale_features(features)
         
         return None
     
+    def scale_features(self, features):
+        """
+        Normalizza le feature con lo scaler fissato in addestramento
+        
+        Args:
+            features: Array di feature grezze
+            
+        Returns:
+            Feature normalizzate
+        """
+        if not hasattr(self.scaler, 'mean_'):
+            # Nessuno scaler addestrato (es. modello di default): feature non normalizzate
+            return np.asarray(features, dtype=np.float64)
+        return self.scaler.transform(features)
+    
     def _extract_features(self, data):
         """
         Estrae le feature dai dati grezzi
@@ -189,7 +282,7 @@ class OperationalOptimizer:
         }
         return type_map.get(task_type.lower(), 0.33)
     
-    def train_model(self, training_data, target_data, epochs=100, batch_size=32, learning_rate=0.001):
+    def train_model(self, training_data, target_data, epochs=100, batch_size=32, learning_rate=0.001, hidden_size=20):
         """
         Addestra il modello predittivo
         
@@ -199,13 +292,14 @@ class OperationalOptimizer:
             epochs: Numero di epoche
             batch_size: Dimensione del batch
             learning_rate: Tasso di apprendimento
+            hidden_size: Neuroni degli strati nascosti
             
         Returns:
             Storico dell'addestramento
         """
         try:
             # Preprocessa i dati
-            X = self.preprocess_data(training_data)
+            X = self.preprocess_data(training_data, fit=True)
             y = np.array(target_data)
             
             # Dividi in training e validation
@@ -220,7 +314,6 @@ class OperationalOptimizer:
             # Crea il modello
             input_size = X_train.shape[1]
             output_size = y_train.shape[1] if len(y_train.shape) > 1 else 1
-            hidden_size = 20
             
             self.model = PredictiveModel(input_size, hidden_size, output_size)
             self.model.to(self.device)
@@ -281,6 +374,11 @@ class OperationalOptimizer:
             return
         
         try:
+            if is_safetensors_checkpoint(model_path):
+                save_optimizer_checkpoint(self, model_path)
+                print(f"Modello salvato in {model_path}")
+                return
+            
             # Crea il dizionario con i parametri del modello
             checkpoint = {
                 'model_state_dict': self.model.state_dict(),
@@ -312,29 +410,73 @@ class OperationalOptimizer:
             return self._simulate_prediction(data)
         
         try:
+            if self.routed_models and isinstance(data, pd.DataFrame) and self.route_field in data:
+                # Ogni attività usa il modello della propria sede, se presente
+                features = self._extract_features(data)
+                if features is None:
+                    return self._simulate_prediction(data)
+                return self.predict_features(features, data[self.route_field].to_numpy())
+            
             # Preprocessa i dati
             X = self.preprocess_data(data)
             
             if X is None:
                 return self._simulate_prediction(data)
             
-            # Converti in tensore PyTorch
-            X_tensor = torch.FloatTensor(X).to(self.device)
-            
-            # Esegui la predizione
-            self.model.eval()
-            with torch.no_grad():
-                predictions = self.model(X_tensor)
-            
-            # Converti in numpy array
-            predictions = predictions.cpu().numpy()
-            
-            return predictions
+            return self._forward(X)
             
         except Exception as e:
             print(f"Errore nella predizione: {e}")
             return self._simulate_prediction(data)
     
+    def predict_features(self, features, groups=None):
+        """
+        Esegue predizioni su feature già estratte (non normalizzate)
+        
+        Args:
+            features: Array di feature grezze (n x 10)
+            groups: Sede o cliente di ogni riga, per usare i modelli dell'indice (opzionale)
+            
+        Returns:
+            Predizioni
+        """
+        if not self.routed_models or groups is None:
+            return self._forward(self.scale_features(features))
+        
+        features = np.asarray(features)
+        groups = np.asarray([None if g is None else str(g) for g in groups], dtype=object)
+        predictions = None
+        remaining = np.ones(len(features), dtype=bool)
+        for group in set(groups) & set(self.routed_models):
+            mask = groups == group
+            output = self.routed_models[group].predict_features(features[mask])
+            if predictions is None:
+                predictions = np.zeros((len(features), output.shape[1]), dtype=output.dtype)
+            predictions[mask] = output
+            remaining &= ~mask
+        
+        if remaining.any():
+            output = self._forward(self.scale_features(features[remaining]))
+            if predictions is None:
+                predictions = np.zeros((len(features), output.shape[1]), dtype=output.dtype)
+            predictions[remaining] = output
+        return predictions
+    
+    def _forward(self, X):
+        """
+        Esegue un passaggio del modello su feature normalizzate
+        """
+        # Converti in tensore PyTorch
+        X_tensor = torch.FloatTensor(X).to(self.device)
+        
+        # Esegui la predizione
+        self.model.eval()
+        with torch.no_grad():
+            predictions = self.model(X_tensor)
+        
+        # Converti in numpy array
+        return predictions.cpu().numpy()
+    
     def _simulate_prediction(self, data):
         """
         Simula una predizione per scopi dimostrativi
@@ -388,7 +530,7 @@ class OperationalOptimizer:
         
         return np.array(predictions)
     
-    def optimize_schedule(self, tasks, staff_count, start_date, end_date):
+    def optimize_schedule(self, tasks, staff_count, start_date, end_date, predict_fn=None):
         """
         Ottimizza la pianificazione delle attività di pulizia
         
@@ -397,39 +539,160 @@ class OperationalOptimizer:
             staff_count: Numero di operatori disponibili
             start_date: Data di inizio della pianificazione
             end_date: Data di fine della pianificazione
+            predict_fn: Funzione di predizione alternativa a self.predict (opzionale)
             
         Returns:
             Pianificazione ottimizzata
         """
         try:
-            # Converti le date in datetime
-            if isinstance(start_date, str):
-                start_date = datetime.fromisoformat(start_date.replace('Z', '+00:00'))
-            if isinstance(end_date, str):
-                end_date = datetime.fromisoformat(end_date.replace('Z', '+00:00'))
-            
-            # Calcola il numero di giorni disponibili
-            days_available = (end_date - start_date).days + 1
-            
-            # Prepara i dati per la predizione
-            tasks_df = pd.DataFrame(tasks)
-            
-            # Aggiungi la colonna staff_available
-            tasks_df['staff_available'] = staff_count
-            
-            # Esegui la predizione per ottenere durata e priorità
-            predictions = self.predict(tasks_df)
-            
-            # Aggiungi le predizioni al DataFrame
-            tasks_df['estimated_duration'] = predictions[:, 0]
-            tasks_df['expected_quality'] = predictions[:, 1]
-            tasks_df['suggested_priority'] = predictions[:, 2]
-            
-            # Converti la priorità suggerita in una categoria
-            def priority_to_category(priority):
-                if priority >= 0.75:
-                    return 'urgent'
-                elif priority >= 0.5:
-                    return 'high'
-                elif priority >= 0.25:
-              <response clipped><NOTE>To save on context only part of this file has been shown to you. You should retry this tool after you have searched inside the file with `grep -n` in order to find the line numbers of what you are looking for.</NOTE>
\ No newline at end of file
+            schedule_df, summary = self.optimize_schedule_frame(tasks, staff_count, start_date, end_date, predict_fn)
+            
+            schedule_df['scheduled_at'] = schedule_df['scheduled_at'].map(lambda ts: ts.isoformat())
+            schedule_df = schedule_df.astype(object).where(schedule_df.notna(), None)
+            return {
+                'schedule': schedule_df.to_dict('records'),
+                **summary
+            }
+            
+        except Exception as e:
+            print(f"Errore nell'ottimizzazione della pianificazione: {e}")
+            return {"error": str(e)}
+    
+    def optimize_schedule_frame(self, tasks, staff_count, start_date, end_date, predict_fn=None):
+        """
+        Ottimizza la pianificazione restituendo le righe in forma colonnare,
+        senza costruire un dizionario per ogni attività
+        
+        Args:
+            tasks: Lista di attività o DataFrame
+            staff_count: Numero di operatori disponibili
+            start_date: Data di inizio della pianificazione
+            end_date: Data di fine della pianificazione
+            predict_fn: Funzione di predizione alternativa a self.predict (opzionale)
+            
+        Returns:
+            Tupla (DataFrame della pianificazione, dizionario riassuntivo)
+        """
+        # Converti le date in datetime
+        if isinstance(start_date, str):
+            start_date = datetime.fromisoformat(start_date.replace('Z', '+00:00'))
+        if isinstance(end_date, str):
+            end_date = datetime.fromisoformat(end_date.replace('Z', '+00:00'))
+        
+        # Calcola il numero di giorni disponibili
+        days_available = (end_date - start_date).days + 1
+        
+        # Prepara i dati per la predizione
+        tasks_df = pd.DataFrame(tasks)
+        
+        # Aggiungi la colonna staff_available
+        tasks_df['staff_available'] = staff_count
+        
+        # Esegui la predizione per ottenere durata e priorità
+        predictions = (predict_fn or self.predict)(tasks_df)
+        
+        # Aggiungi le predizioni al DataFrame
+        tasks_df['estimated_duration'] = predictions[:, 0]
+        tasks_df['expected_quality'] = predictions[:, 1]
+        tasks_df['suggested_priority'] = predictions[:, 2]
+        
+        # Converti la priorità suggerita in una categoria
+        tasks_df['priority_category'] = pd.cut(
+            tasks_df['suggested_priority'],
+            bins=[-np.inf, 0.25, 0.5, 0.75, np.inf],
+            labels=['low', 'medium', 'high', 'urgent'],
+            right=False
+        ).astype(str)
+        
+        # Ordina le attività per priorità suggerita (decrescente)
+        tasks_df = tasks_df.sort_values('suggested_priority', ascending=False).reset_index(drop=True)
+        
+        # Minuti lavorativi disponibili per operatore al giorno (8 ore)
+        minutes_per_day = 8 * 60
+        staff_load = np.zeros((max(1, staff_count), max(1, days_available)))
+        
+        durations = tasks_df['estimated_duration'].to_numpy(dtype=np.float64)
+        num_tasks = len(durations)
+        assigned_staff = np.full(num_tasks, -1, dtype=np.int32)
+        assigned_day = np.full(num_tasks, -1, dtype=np.int32)
+        start_minutes = np.zeros(num_tasks, dtype=np.float64)
+        
+        for i in range(num_tasks):
+            # Per ogni giorno l'operatore meno carico; primo giorno in cui l'attività entra
+            staff_idx = np.argmin(staff_load, axis=0)
+            min_load = staff_load[staff_idx, np.arange(staff_load.shape[1])]
+            fits = np.nonzero(min_load + durations[i] <= minutes_per_day)[0]
+            if len(fits) == 0:
+                continue
+            day = fits[0]
+            assigned_staff[i] = staff_idx[day]
+            assigned_day[i] = day
+            start_minutes[i] = min_load[day]
+            staff_load[staff_idx[day], day] += durations[i]
+        
+        assigned = assigned_staff >= 0
+        scheduled_at = (
+            pd.Timestamp(start_date)
+            + pd.to_timedelta(assigned_day[assigned], unit='D')
+            + pd.Timedelta(hours=8)
+            + pd.to_timedelta(start_minutes[assigned], unit='m')
+        )
+        
+        def column(name):
+            if name in tasks_df:
+                return tasks_df[name].to_numpy()
+            return np.full(num_tasks, None, dtype=object)
+        
+        task_ids = column('id')
+        schedule_df = pd.DataFrame({
+            'task_id': task_ids[assigned],
+            'location_id': column('location_id')[assigned],
+            'staff_index': assigned_staff[assigned],
+            'scheduled_at': scheduled_at,
+            'estimated_duration': durations[assigned],
+            'expected_quality': tasks_df['expected_quality'].to_numpy(dtype=np.float64)[assigned],
+            'priority': tasks_df['priority_category'].to_numpy()[assigned]
+        })
+        
+        # Calcola l'utilizzo degli operatori
+        staff_utilization = float(staff_load.sum() / (staff_load.size * minutes_per_day))
+        
+        summary = {
+            'unscheduled_tasks': task_ids[~assigned].tolist(),
+            'total_tasks': num_tasks,
+            'scheduled_tasks': int(assigned.sum()),
+            'staff_utilization': staff_utilization,
+            'days_available': days_available
+        }
+        
+        return schedule_df, summary
+
+class PredictiveModel(nn.Module):
+    """
+    Rete neurale per la predizione di durata, qualità e priorità delle attività
+    """
+    
+    def __init__(self, input_size, hidden_size, output_size):
+        """
+        Inizializza il modello predittivo
+        
+        Args:
+            input_size: Numero di feature in ingresso
+            hidden_size: Dimensione dello strato nascosto
+            output_size: Numero di valori in uscita
+        """
+        super(PredictiveModel, self).__init__()
+        self.input_size = input_size
+        self.hidden_size = hidden_size
+        self.output_size = output_size
+        
+        self.layers = nn.Sequential(
+            nn.Linear(input_size, hidden_size),
+            nn.ReLU(),
+            nn.Linear(hidden_size, hidden_size),
+            nn.ReLU(),
+            nn.Linear(hidden_size, output_size)
+        )
+    
+    def forward(self, x):
+        return self.layers(x)
@@ -0,0 +1,358 @@
+# Servizio di predizione per OperationalOptimizer
+# Dashboard, pianificatore e notifiche chiedono più volte le predizioni per le stesse attività.
+# Il servizio memorizza per ogni attività il vettore di feature e la predizione
+# (per versione del modello) e per ogni combinazione di input, così chiamanti che passano
+# input diversi (es. staff_available) non si sostituiscono a vicenda le voci,
+# e raggruppa le chiamate concorrenti in un unico passaggio del modello.
+
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+import pandas as pd
+
+# Campi letti da OperationalOptimizer._extract_features: solo questi distinguono le voci della cache
+FEATURE_FIELDS = (
+    'scheduled_at', 'location_size', 'priority', 'task_type', 'days_since_last_cleaned',
+    'foot_traffic', 'humidity', 'temperature', 'dirt_level', 'staff_available',
+)
+
+# Campi che scelgono il modello di sede o cliente nell'indice dei modelli
+ROUTING_FIELDS = ('location_id', 'client_id')
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+def _is_missing(value):
+    try:
+        return bool(pd.isna(value))
+    except (TypeError, ValueError):
+        return False
+
+
+def _clean_task(task):
+    # I record di un DataFrame hanno NaN per le colonne assenti nell'attività:
+    # le togliamo perché _extract_features usi i valori di default
+    return {key: value for key, value in task.items() if not _is_missing(value)}
+
+
+def task_fingerprint(task):
+    """
+    Impronta degli input di un'attività che influenzano la predizione
+    """
+    fields = {name: task[name] for name in FEATURE_FIELDS + ROUTING_FIELDS if name in task}
+    return json.dumps(fields, sort_keys=True, default=_json_default)
+
+
+class _LRUCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = OrderedDict()
+
+    def get(self, key):
+        value = self._data.get(key)
+        if value is not None:
+            self._data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def pop_task(self, task_id):
+        """
+        Rimuove tutte le voci di un'attività (chiavi (task_id, impronta))
+
+        Returns:
+            Numero di voci rimosse
+        """
+        keys = [key for key in self._data if key[0] == task_id]
+        for key in keys:
+            del self._data[key]
+        return len(keys)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class _PendingTask:
+    def __init__(self, task, task_id, fingerprint):
+        self.task = task
+        self.task_id = task_id
+        self.fingerprint = fingerprint
+        self.future = Future()
+
+
+class PredictionService:
+    """
+    Predizioni memorizzate e raggruppate sopra il registro di OperationalOptimizer
+    """
+
+    def __init__(self, registry, max_batch_size=1024, max_wait_ms=5, cache_size=10000, id_field='id'):
+        """
+        Inizializza il servizio
+
+        Args:
+            registry: ModelRegistry di OperationalOptimizer
+            max_batch_size: Numero massimo di attività per passaggio del modello
+            max_wait_ms: Attesa massima per raccogliere altre richieste in un batch
+            cache_size: Numero massimo di attività memorizzate
+            id_field: Campo con l'identificativo dell'attività
+        """
+        self.registry = registry
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.id_field = id_field
+
+        # (task_id, impronta) -> vettore di feature grezzo
+        self._features = _LRUCache(cache_size)
+        # (task_id, impronta) -> (versione del modello, predizione)
+        self._predictions = _LRUCache(cache_size)
+        self._cache_lock = threading.Lock()
+
+        self._pending = []
+        # (task_id, impronta) -> attività in attesa, per unire richieste identiche
+        self._in_flight = {}
+        self._queue_lock = threading.Condition()
+        self._worker = None
+
+        self._stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self.stats_counts = {
+                "requests": 0,
+                "tasks": 0,
+                "prediction_hits": 0,
+                "feature_hits": 0,
+                "coalesced": 0,
+                "batches": 0,
+                "batched_tasks": 0,
+                "simulated": 0,
+            }
+
+    def _count(self, **counts):
+        with self._stats_lock:
+            for key, value in counts.items():
+                self.stats_counts[key] += value
+
+    def _task_id(self, task):
+        task_id = task.get(self.id_field)
+        return None if task_id is None else str(task_id)
+
+    def _cacheable(self, task_id, task):
+        # Senza scheduled_at _extract_features usa l'ora corrente: la voce resterebbe ferma a quell'ora
+        return task_id is not None and 'scheduled_at' in task
+
+    def predict(self, tasks):
+        """
+        Restituisce le predizioni per le attività, nello stesso formato di OperationalOptimizer.predict
+
+        Args:
+            tasks: Lista di attività, singola attività o DataFrame
+
+        Returns:
+            Array numpy (n x 3): durata stimata, qualità prevista, priorità suggerita
+        """
+        if isinstance(tasks, pd.DataFrame):
+            tasks = tasks.to_dict('records')
+        elif isinstance(tasks, dict):
+            tasks = [tasks]
+        tasks = [_clean_task(task) for task in tasks]
+
+        results = [None] * len(tasks)
+        waiting = []
+        active = self.registry.active
+        active_version = active.version if active is not None else None
+
+        hits = 0
+        coalesced = 0
+        for i, task in enumerate(tasks):
+            task_id = self._task_id(task)
+            fingerprint = task_fingerprint(task)
+
+            if self._cacheable(task_id, task) and active_version is not None:
+                with self._cache_lock:
+                    cached = self._predictions.get((task_id, fingerprint))
+                if cached is not None and cached[0] == active_version:
+                    results[i] = cached[1]
+                    hits += 1
+                    continue
+
+            with self._queue_lock:
+                key = (task_id, fingerprint) if task_id is not None else None
+                pending = self._in_flight.get(key) if key is not None else None
+                if pending is not None:
+                    coalesced += 1
+                else:
+                    pending = _PendingTask(task, task_id, fingerprint)
+                    if key is not None:
+                        self._in_flight[key] = pending
+                    self._pending.append(pending)
+                    self._queue_lock.notify()
+            waiting.append((i, pending))
+
+        if waiting:
+            self._ensure_worker()
+        self._count(requests=1, tasks=len(tasks), prediction_hits=hits, coalesced=coalesced)
+
+        for i, pending in waiting:
+            results[i] = pending.future.result()
+
+        if not results:
+            return np.zeros((0, 3))
+        return np.vstack(results)
+
+    def invalidate(self, task_ids=None):
+        """
+        Rimuove dalla cache le attività indicate, con tutte le loro varianti di input
+        (tutte le attività se task_ids è None)
+
+        Returns:
+            Numero di voci di predizione rimosse
+        """
+        with self._cache_lock:
+            if task_ids is None:
+                removed = len(self._predictions)
+                self._features.clear()
+                self._predictions.clear()
+                return removed
+            removed = 0
+            for task_id in task_ids:
+                task_id = str(task_id)
+                removed += self._predictions.pop_task(task_id)
+                self._features.pop_task(task_id)
+            return removed
+
+    def _ensure_worker(self):
+        with self._queue_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="prediction-service", daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            with self._queue_lock:
+                while not self._pending:
+                    self._queue_lock.wait()
+
+                # Attendi brevemente altre richieste concorrenti da unire nello stesso batch
+                deadline = time.perf_counter() + self.max_wait
+                while len(self._pending) < self.max_batch_size:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    self._queue_lock.wait(remaining)
+
+                batch = self._pending[:self.max_batch_size]
+                del self._pending[:self.max_batch_size]
+
+            try:
+                predictions = self._predict_batch(batch)
+                for pending, prediction in zip(batch, predictions):
+                    pending.future.set_result(prediction)
+            except Exception as e:
+                print(f"Errore nel servizio di predizione: {e}")
+                for pending in batch:
+                    if not pending.future.done():
+                        pending.future.set_exception(e)
+            finally:
+                with self._queue_lock:
+                    for pending in batch:
+                        key = (pending.task_id, pending.fingerprint)
+                        if self._in_flight.get(key) is pending:
+                            del self._in_flight[key]
+
+    def _groups(self, items):
+        # Un DataFrame per ogni insieme di campi, così i campi assenti usano i default
+        groups = {}
+        for index, pending in items:
+            groups.setdefault(frozenset(pending.task), []).append((index, pending))
+        for group in groups.values():
+            yield [index for index, _ in group], pd.DataFrame([pending.task for _, pending in group])
+
+    def _predict_batch(self, batch):
+        """
+        Calcola le predizioni di un batch con un solo passaggio del modello
+        """
+        self._count(batches=1, batched_tasks=len(batch))
+
+        with self.registry.acquire_version() as version:
+            optimizer = version.instance
+            predictions = [None] * len(batch)
+
+            if optimizer.model is None:
+                # Nessun modello: predizione simulata, non memorizzata
+                for indices, frame in self._groups(enumerate(batch)):
+                    for index, prediction in zip(indices, optimizer._simulate_prediction(frame)):
+                        predictions[index] = prediction
+                self._count(simulated=len(batch))
+                return predictions
+
+            # Feature memorizzate per le attività i cui input non sono cambiati
+            features = [None] * len(batch)
+            missing = []
+            with self._cache_lock:
+                for index, pending in enumerate(batch):
+                    cached = None
+                    if self._cacheable(pending.task_id, pending.task):
+                        cached = self._features.get((pending.task_id, pending.fingerprint))
+                    if cached is not None:
+                        features[index] = cached
+                    else:
+                        missing.append((index, pending))
+            self._count(feature_hits=len(batch) - len(missing))
+
+            for indices, frame in self._groups(missing):
+                extracted = optimizer._extract_features(frame)
+                if extracted is None:
+                    raise ValueError("Estrazione delle feature non riuscita")
+                for index, vector in zip(indices, extracted):
+                    features[index] = vector
+
+            # Un solo passaggio del modello per tutto il batch (uno per sede con l'indice dei modelli)
+            groups = None
+            if optimizer.route_field:
+                groups = [pending.task.get(optimizer.route_field) for pending in batch]
+            output = optimizer.predict_features(np.vstack(features), groups)
+
+            with self._cache_lock:
+                for index, pending in enumerate(batch):
+                    predictions[index] = output[index]
+                    if self._cacheable(pending.task_id, pending.task):
+                        key = (pending.task_id, pending.fingerprint)
+                        self._features.put(key, features[index])
+                        self._predictions.put(key, (version.version, output[index]))
+
+            return predictions
+
+    def stats(self):
+        """
+        Restituisce contatori di cache e dimensione media dei batch
+        """
+        with self._stats_lock:
+            counts = dict(self.stats_counts)
+        with self._cache_lock:
+            cached = len(self._predictions)
+        return {
+            **counts,
+            "cached_tasks": cached,
+            "hit_rate": counts["prediction_hits"] / counts["tasks"] if counts["tasks"] else 0.0,
+            "average_batch_size": counts["batched_tasks"] / counts["batches"] if counts["batches"] else 0.0,
+        }
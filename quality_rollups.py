@@ -0,0 +1,504 @@
+# Aggregati precalcolati della qualità delle pulizie per i grafici di andamento
+# Mantiene per ogni location aggregati giornalieri e settimanali (conteggio, media,
+# istogramma di quality_score e rilevazioni per etichetta) in forma colonnare,
+# aggiornati in modo incrementale all'arrivo di nuovi report.
+# I report arrivano in ordine di completed_at (come in cleaning_reports): per ogni location
+# si ricorda solo l'ultimo report aggregato, così un report già visto non viene
+# contato due volte senza conservare tutti gli identificativi.
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from datetime import date, datetime
+
+import numpy as np
+
+GRANULARITIES = ("day", "week")
+
+# Location fittizia che aggrega tutte le location, per i grafici complessivi
+ALL_LOCATIONS = "__all__"
+
+# quality_score è un intero 0-100: istogramma a 20 classi di ampiezza 5
+HISTOGRAM_BINS = 20
+SCORE_MAX = 100
+
+# Campi obbligatori di un report (completed_at può essere sostituito da created_at)
+REQUIRED_FIELDS = ("location_id", "quality_score", "completed_at")
+
+
+def _to_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.fromisoformat(str(value).replace('Z', '+00:00')).date()
+
+
+def _to_timestamp(value):
+    if isinstance(value, datetime):
+        return value.timestamp()
+    if isinstance(value, date):
+        return datetime.combine(value, datetime.min.time()).timestamp()
+    return datetime.fromisoformat(str(value).replace('Z', '+00:00')).timestamp()
+
+
+def missing_fields(report):
+    """
+    Restituisce i campi obbligatori assenti in un report
+    """
+    missing = []
+    for field in REQUIRED_FIELDS:
+        value = report.get(field)
+        if value is None and field == "completed_at":
+            value = report.get("created_at")
+        if value is None:
+            missing.append(field)
+    return missing
+
+
+def bucket_of(value, granularity):
+    """
+    Calcola l'indice del periodo di una data
+
+    Args:
+        value: Data o timestamp (anche stringa ISO)
+        granularity: "day" oppure "week" (settimane da lunedì)
+
+    Returns:
+        Intero che identifica il periodo
+    """
+    ordinal = _to_date(value).toordinal()
+    if granularity == "day":
+        return ordinal
+    # date(1, 1, 1) è un lunedì, quindi le settimane partono da lunedì
+    return (ordinal - 1) // 7
+
+
+def bucket_start(bucket, granularity):
+    """
+    Restituisce la data di inizio di un periodo
+    """
+    if granularity == "day":
+        return date.fromordinal(bucket)
+    return date.fromordinal(bucket * 7 + 1)
+
+
+def extract_labels(ai_analysis_result):
+    """
+    Estrae le etichette dei problemi rilevati dal risultato dell'analisi AI.
+    Per i confronti prima/dopo contano le rilevazioni dopo la pulizia.
+
+    Args:
+        ai_analysis_result: Dizionario (o stringa JSON) salvato in cleaning_reports
+
+    Returns:
+        Lista di etichette
+    """
+    if not ai_analysis_result:
+        return []
+    if isinstance(ai_analysis_result, str):
+        try:
+            ai_analysis_result = json.loads(ai_analysis_result)
+        except ValueError:
+            return []
+
+    detections = ai_analysis_result.get("after_detections")
+    if detections is None:
+        detections = ai_analysis_result.get("detections", [])
+
+    return [d["label"] for d in detections if isinstance(d, dict) and d.get("label")]
+
+
+class RollupTable:
+    """
+    Aggregati di una granularità in forma colonnare.
+    Ogni riga corrisponde a una coppia (location, periodo).
+    """
+
+    def __init__(self, granularity, capacity=1024, num_labels=8):
+        self.granularity = granularity
+        self.size = 0
+        self.rows = {}
+
+        self.location = np.zeros(capacity, dtype=np.int32)
+        self.bucket = np.zeros(capacity, dtype=np.int32)
+        self.count = np.zeros(capacity, dtype=np.uint32)
+        self.score_sum = np.zeros(capacity, dtype=np.float64)
+        self.histogram = np.zeros((capacity, HISTOGRAM_BINS), dtype=np.uint32)
+        self.label_counts = np.zeros((capacity, num_labels), dtype=np.uint32)
+
+    def _grow(self, min_capacity):
+        capacity = max(min_capacity, len(self.count) * 2)
+        for name in ("location", "bucket", "count", "score_sum", "histogram", "label_counts"):
+            column = getattr(self, name)
+            grown = np.zeros((capacity,) + column.shape[1:], dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            setattr(self, name, grown)
+
+    def ensure_labels(self, num_labels):
+        if num_labels > self.label_counts.shape[1]:
+            grown = np.zeros((len(self.count), max(num_labels, self.label_counts.shape[1] * 2)), dtype=np.uint32)
+            grown[:, :self.label_counts.shape[1]] = self.label_counts
+            self.label_counts = grown
+
+    def row_for(self, location_idx, bucket):
+        key = (location_idx, bucket)
+        row = self.rows.get(key)
+        if row is None:
+            if self.size == len(self.count):
+                self._grow(self.size + 1)
+            row = self.size
+            self.size += 1
+            self.location[row] = location_idx
+            self.bucket[row] = bucket
+            self.rows[key] = row
+        return row
+
+    def add(self, location_idx, bucket, score, score_bin, label_indices):
+        row = self.row_for(location_idx, bucket)
+        self.count[row] += 1
+        self.score_sum[row] += score
+        self.histogram[row, score_bin] += 1
+        if len(label_indices):
+            np.add.at(self.label_counts[row], label_indices, 1)
+
+    def lookup(self, location_idx, buckets):
+        """
+        Restituisce le righe dei periodi richiesti per una location (-1 se assenti)
+        """
+        return np.array([self.rows.get((location_idx, int(b)), -1) for b in buckets], dtype=np.int64)
+
+    def to_arrays(self, prefix):
+        return {
+            f"{prefix}_location": self.location[:self.size],
+            f"{prefix}_bucket": self.bucket[:self.size],
+            f"{prefix}_count": self.count[:self.size],
+            f"{prefix}_score_sum": self.score_sum[:self.size],
+            f"{prefix}_histogram": self.histogram[:self.size],
+            f"{prefix}_label_counts": self.label_counts[:self.size],
+        }
+
+    @classmethod
+    def from_arrays(cls, granularity, arrays, prefix):
+        location = arrays[f"{prefix}_location"]
+        table = cls(granularity, capacity=max(1024, len(location)),
+                    num_labels=max(8, arrays[f"{prefix}_label_counts"].shape[1]))
+        size = len(location)
+        table.size = size
+        table.location[:size] = location
+        table.bucket[:size] = arrays[f"{prefix}_bucket"]
+        table.count[:size] = arrays[f"{prefix}_count"]
+        table.score_sum[:size] = arrays[f"{prefix}_score_sum"]
+        table.histogram[:size] = arrays[f"{prefix}_histogram"]
+        labels = arrays[f"{prefix}_label_counts"]
+        table.label_counts[:size, :labels.shape[1]] = labels
+        table.rows = {(int(l), int(b)): i for i, (l, b) in enumerate(zip(table.location[:size], table.bucket[:size]))}
+        return table
+
+
+class QualityRollupStore:
+    """
+    Archivio degli aggregati di qualità per location, giorno e settimana
+    """
+
+    def __init__(self, path=None, save_interval=5.0):
+        """
+        Inizializza l'archivio
+
+        Args:
+            path: File .npz dove salvare gli aggregati (opzionale)
+            save_interval: Secondi di attesa di schedule_save, per raggruppare
+                in un solo salvataggio i report arrivati nel frattempo
+        """
+        self.path = path
+        self.locations = []
+        self.location_index = {}
+        self.labels = []
+        self.label_index = {}
+        self.tables = {g: RollupTable(g) for g in GRANULARITIES}
+        self.reports_ingested = 0
+        self.last_completed_at = None
+        # location_id -> (completed_at, chiave) dell'ultimo report aggregato
+        self.watermarks = {}
+        self.save_interval = save_interval
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._save_timer = None
+
+        if path and os.path.exists(path):
+            self.load(path)
+
+    def _location_idx(self, location_id):
+        idx = self.location_index.get(location_id)
+        if idx is None:
+            idx = len(self.locations)
+            self.locations.append(location_id)
+            self.location_index[location_id] = idx
+        return idx
+
+    def _label_idx(self, label):
+        idx = self.label_index.get(label)
+        if idx is None:
+            idx = len(self.labels)
+            self.labels.append(label)
+            self.label_index[label] = idx
+            for table in self.tables.values():
+                table.ensure_labels(len(self.labels))
+        return idx
+
+    def _report_order(self, report):
+        # Ordine dei report: completed_at, poi id (o impronta del contenuto se manca)
+        completed_at = report.get("completed_at") or report.get("created_at")
+        report_id = report.get("id") or report.get("report_id")
+        if report_id is None:
+            content = json.dumps(
+                [report.get("location_id"), str(completed_at), report.get("quality_score"),
+                 report.get("ai_analysis_result")],
+                sort_keys=True, default=str)
+            report_id = "sha1:" + hashlib.sha1(content.encode()).hexdigest()
+        return _to_timestamp(completed_at), str(report_id)
+
+    def add_report(self, report):
+        """
+        Aggiunge un report agli aggregati. Un report non successivo all'ultimo
+        aggregato per la sua location (per completed_at e id) è già stato visto
+        e viene ignorato.
+
+        Args:
+            report: Dizionario con id, location_id, quality_score (0-100),
+                completed_at e ai_analysis_result
+
+        Returns:
+            True se il report è stato aggiunto
+
+        Raises:
+            ValueError: Se mancano campi obbligatori
+        """
+        missing = missing_fields(report)
+        if missing:
+            raise ValueError(f"Campi mancanti nel report: {', '.join(missing)}")
+
+        score = report["quality_score"]
+        completed_at = report.get("completed_at") or report.get("created_at")
+        location_id = report["location_id"]
+
+        score = float(min(SCORE_MAX, max(0, score)))
+        score_bin = min(HISTOGRAM_BINS - 1, int(score * HISTOGRAM_BINS / (SCORE_MAX + 1)))
+        labels = extract_labels(report.get("ai_analysis_result"))
+        order = self._report_order(report)
+
+        with self._lock:
+            watermark = self.watermarks.get(location_id)
+            if watermark is not None and order <= watermark:
+                return False
+            self.watermarks[location_id] = order
+
+            label_indices = np.array([self._label_idx(label) for label in labels], dtype=np.int64)
+            location_indices = (self._location_idx(location_id), self._location_idx(ALL_LOCATIONS))
+
+            for granularity, table in self.tables.items():
+                bucket = bucket_of(completed_at, granularity)
+                for location_idx in location_indices:
+                    table.add(location_idx, bucket, score, score_bin, label_indices)
+
+            self.reports_ingested += 1
+            completed_date = _to_date(completed_at)
+            if self.last_completed_at is None or completed_date > self.last_completed_at:
+                self.last_completed_at = completed_date
+
+        return True
+
+    def add_reports(self, reports):
+        """
+        Aggiunge più report agli aggregati, in ordine di completed_at.
+        Se un report non è valido non viene aggiunto nessun report.
+
+        Returns:
+            Numero di report aggiunti
+
+        Raises:
+            ValueError: Se a un report mancano campi obbligatori
+        """
+        for i, report in enumerate(reports):
+            missing = missing_fields(report)
+            if missing:
+                raise ValueError(f"Campi mancanti nel report {i}: {', '.join(missing)}")
+        ordered = sorted(reports, key=self._report_order)
+        return sum(1 for report in ordered if self.add_report(report))
+
+    def query(self, location_id=None, granularity="day", start=None, end=None, percentiles=(50, 90)):
+        """
+        Restituisce la serie temporale di una location dagli aggregati.
+        Il costo dipende solo dal numero di periodi richiesti, non dal numero di report.
+
+        Args:
+            location_id: Location (None per tutte le location)
+            granularity: "day" oppure "week"
+            start: Data di inizio (default: 30 periodi prima di end)
+            end: Data di fine (default: oggi)
+            percentiles: Percentili di quality_score da calcolare
+
+        Returns:
+            Dizionario con colonne allineate per periodo
+        """
+        if granularity not in self.tables:
+            raise ValueError(f"Granularità non supportata: {granularity}")
+
+        end_bucket = bucket_of(end or date.today(), granularity)
+        start_bucket = bucket_of(start, granularity) if start else end_bucket - 29
+        if start_bucket > end_bucket:
+            raise ValueError("La data di inizio è successiva alla data di fine")
+
+        buckets = np.arange(start_bucket, end_bucket + 1)
+        table = self.tables[granularity]
+
+        with self._lock:
+            location_idx = self.location_index.get(location_id if location_id is not None else ALL_LOCATIONS)
+            if location_idx is None:
+                rows = np.full(len(buckets), -1, dtype=np.int64)
+            else:
+                rows = table.lookup(location_idx, buckets)
+
+            present = rows >= 0
+            rows = rows[present]
+            count = table.count[rows].astype(np.int64)
+            score_sum = table.score_sum[rows]
+            histogram = table.histogram[rows].astype(np.int64)
+            label_counts = table.label_counts[rows, :len(self.labels)]
+            labels = list(self.labels)
+
+        mean = np.divide(score_sum, count, out=np.zeros(len(count)), where=count > 0)
+
+        return {
+            "location_id": location_id,
+            "granularity": granularity,
+            "bucket_start": [bucket_start(int(b), granularity).isoformat() for b in buckets[present]],
+            "count": count.tolist(),
+            "mean_quality_score": np.round(mean, 2).tolist(),
+            **{f"p{p}_quality_score": self._histogram_percentile(histogram, p).tolist() for p in percentiles},
+            "detections_by_label": {
+                label: label_counts[:, i].astype(np.int64).tolist() for i, label in enumerate(labels)
+            },
+        }
+
+    def _histogram_percentile(self, histogram, p):
+        """
+        Stima un percentile per ogni riga dell'istogramma, con interpolazione
+        lineare all'interno della classe
+        """
+        if len(histogram) == 0:
+            return np.zeros(0)
+        bin_width = (SCORE_MAX + 1) / HISTOGRAM_BINS
+        cumulative = np.cumsum(histogram, axis=1)
+        totals = cumulative[:, -1]
+        target = totals * p / 100
+
+        bin_idx = np.argmax(cumulative >= target[:, None], axis=1)
+        rows = np.arange(len(histogram))
+        below = np.where(bin_idx > 0, cumulative[rows, np.maximum(bin_idx - 1, 0)], 0)
+        in_bin = histogram[rows, bin_idx]
+        fraction = np.divide(target - below, in_bin, out=np.zeros(len(rows)), where=in_bin > 0)
+
+        values = (bin_idx + fraction) * bin_width
+        return np.round(np.minimum(values, SCORE_MAX), 1)
+
+    def stats(self):
+        """
+        Restituisce informazioni sullo stato dell'archivio
+        """
+        with self._lock:
+            return {
+                "reports_ingested": self.reports_ingested,
+                "last_completed_at": self.last_completed_at.isoformat() if self.last_completed_at else None,
+                "locations": len(self.locations) - (1 if ALL_LOCATIONS in self.location_index else 0),
+                "labels": list(self.labels),
+                "rows": {g: t.size for g, t in self.tables.items()},
+            }
+
+    def save(self, path=None):
+        """
+        Salva gli aggregati in un file .npz compresso
+        """
+        path = path or self.path
+        if not path:
+            return
+        # Un salvataggio alla volta. Sotto il lock dei dati si copiano solo le righe
+        # degli aggregati e le soglie per location; conversione e scrittura avvengono fuori
+        with self._save_lock:
+            with self._lock:
+                locations = list(self.locations)
+                labels = list(self.labels)
+                watermarks = list(self.watermarks.items())
+                meta = [self.reports_ingested, self.last_completed_at.toordinal() if self.last_completed_at else 0]
+                tables = {granularity: {key: value.copy() for key, value in table.to_arrays(granularity).items()}
+                          for granularity, table in self.tables.items()}
+
+            arrays = {
+                "locations": np.array(locations, dtype=str),
+                "labels": np.array(labels, dtype=str),
+                "meta": np.array(meta),
+                "watermark_locations": np.array([str(l) for l, _ in watermarks], dtype=str),
+                "watermark_times": np.array([w[0] for _, w in watermarks], dtype=np.float64),
+                "watermark_keys": np.array([w[1] for _, w in watermarks], dtype=str),
+            }
+            for table_arrays in tables.values():
+                arrays.update(table_arrays)
+
+            # Scrittura atomica tramite file temporaneo univoco nella stessa cartella
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp.npz")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    np.savez_compressed(f, **arrays)
+                os.replace(tmp_path, path)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+    def schedule_save(self):
+        """
+        Programma un salvataggio entro save_interval secondi; le chiamate
+        successive nel frattempo confluiscono nello stesso salvataggio
+        """
+        if not self.path:
+            return
+        with self._lock:
+            if self._save_timer is not None:
+                return
+            self._save_timer = threading.Timer(self.save_interval, self._scheduled_save)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def _scheduled_save(self):
+        with self._lock:
+            self._save_timer = None
+        try:
+            self.save()
+        except Exception as e:
+            print(f"Errore nel salvataggio degli aggregati di qualità: {e}")
+
+    def load(self, path):
+        """
+        Carica gli aggregati da un file .npz
+        """
+        try:
+            with np.load(path) as arrays:
+                data = {key: arrays[key] for key in arrays.files}
+            with self._lock:
+                self.locations = [str(l) for l in data["locations"]]
+                self.location_index = {l: i for i, l in enumerate(self.locations)}
+                self.labels = [str(l) for l in data["labels"]]
+                self.label_index = {l: i for i, l in enumerate(self.labels)}
+                self.reports_ingested = int(data["meta"][0])
+                self.watermarks = {
+                    str(l): (float(t), str(k)) for l, t, k in zip(
+                        data.get("watermark_locations", []), data.get("watermark_times", []),
+                        data.get("watermark_keys", []))
+                }
+                self.last_completed_at = date.fromordinal(int(data["meta"][1])) if data["meta"][1] else None
+                self.tables = {g: RollupTable.from_arrays(g, data, g) for g in GRANULARITIES}
+            print(f"Aggregati di qualità caricati da {path}")
+        except Exception as e:
+            print(f"Errore nel caricamento degli aggregati di qualità: {e}")
@@ -0,0 +1,313 @@
+# Formati di risposta compatti per risultati di analisi e pianificazioni di grandi dimensioni
+# Oltre al JSON sono supportati MessagePack e Arrow IPC, scelti tramite l'header Accept.
+# I formati binari usano un layout colonnare costruito direttamente da array NumPy/pandas
+# e vengono trasmessi a blocchi di righe.
+#
+# Confronto di dimensione e tempo di serializzazione rispetto al JSON:
+#   python response_encoding.py --detections 200000 --schedule-rows 50000
+
+import argparse
+import io
+import json
+import time
+
+import numpy as np
+import pandas as pd
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+JSON = "application/json"
+MSGPACK = "application/x-msgpack"
+ARROW = "application/vnd.apache.arrow.stream"
+
+DEFAULT_CHUNK_ROWS = 8192
+
+
+def available_formats():
+    formats = [JSON]
+    if msgpack is not None:
+        formats.append(MSGPACK)
+    if pa is not None:
+        formats.append(ARROW)
+    return formats
+
+
+def negotiate(accept_header):
+    """
+    Sceglie il formato di risposta in base all'header Accept
+
+    Args:
+        accept_header: Valore dell'header Accept (può essere None)
+
+    Returns:
+        Media type scelto tra quelli disponibili (JSON di default)
+    """
+    if not accept_header:
+        return JSON
+
+    formats = available_formats()
+    best, best_q = JSON, 0.0
+    for item in accept_header.split(","):
+        parts = [p.strip() for p in item.split(";")]
+        media_type = parts[0].lower()
+        q = 1.0
+        for param in parts[1:]:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        if media_type in ("application/msgpack", "application/vnd.msgpack"):
+            media_type = MSGPACK
+        if media_type in formats and q > best_q:
+            best, best_q = media_type, q
+    return best
+
+
+def batch_columns(batch):
+    """
+    Colonne delle rilevazioni di SurfaceAnalyzer.analyze_batch e metadati per immagine
+
+    Returns:
+        Tupla (colonne, metadati)
+    """
+    boxes = batch["box"]
+    columns = {
+        "image_index": batch["image_index"],
+        "label_id": batch["label_id"],
+        "score": batch["score"],
+        "x1": boxes[:, 0],
+        "y1": boxes[:, 1],
+        "x2": boxes[:, 2],
+        "y2": boxes[:, 3],
+    }
+    scores = batch["cleanliness_score"]
+    metadata = {
+        "classes": batch["classes"],
+        "images": len(scores),
+        "cleanliness_score": [None if np.isnan(s) else float(s) for s in scores],
+        "error": batch["error"],
+        "triage_verdict": batch["triage_verdict"],
+        "simulated": batch["simulated"],
+    }
+    return columns, metadata
+
+
+def batch_to_json(batch):
+    """
+    Converte il risultato di analyze_batch nel formato JSON per immagine
+    """
+    classes = batch["classes"]
+    images = []
+    for i, score in enumerate(batch["cleanliness_score"]):
+        images.append({
+            "cleanliness_score": None if np.isnan(score) else float(score),
+            "error": batch["error"][i],
+            "triage_verdict": batch["triage_verdict"][i],
+            "detections": [],
+        })
+
+    for i, label_id, score, box in zip(batch["image_index"].tolist(), batch["label_id"].tolist(),
+                                       batch["score"].tolist(), batch["box"].tolist()):
+        label = classes[label_id] if 0 <= label_id < len(classes) else f"class_{label_id}"
+        images[i]["detections"].append({"box": box, "score": score, "label": label})
+
+    return {"images": images, "simulated": batch["simulated"]}
+
+
+def schedule_columns(schedule_df, summary):
+    """
+    Colonne della pianificazione di OperationalOptimizer.optimize_schedule_frame
+
+    Returns:
+        Tupla (colonne, metadati)
+    """
+    columns = {}
+    for name in schedule_df.columns:
+        series = schedule_df[name]
+        if isinstance(series.dtype, pd.DatetimeTZDtype):
+            series = series.dt.tz_convert("UTC").dt.tz_localize(None)
+        columns[name] = series.to_numpy()
+    return columns, dict(summary)
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
+
+
+def _chunks(columns, chunk_rows):
+    num_rows = len(next(iter(columns.values()))) if columns else 0
+    for start in range(0, max(num_rows, 1), chunk_rows):
+        yield {name: values[start:start + chunk_rows] for name, values in columns.items()}
+
+
+def _pack_column(values):
+    # Colonne numeriche come buffer binario; stringhe e oggetti come lista
+    if values.dtype.kind in "biufM":
+        return {"dtype": values.dtype.str, "data": np.ascontiguousarray(values).tobytes()}
+    return {"dtype": "object", "data": values.tolist()}
+
+
+def iter_msgpack(columns, metadata, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    Genera una sequenza di oggetti MessagePack: un'intestazione con i metadati
+    seguita da un blocco per ogni gruppo di righe. Il client li legge con msgpack.Unpacker.
+    """
+    metadata = json.loads(json.dumps(metadata, default=_json_default))
+    yield msgpack.packb({
+        "type": "header",
+        "metadata": metadata,
+        "columns": list(columns),
+        "rows": len(next(iter(columns.values()))) if columns else 0,
+    })
+    for chunk in _chunks(columns, chunk_rows):
+        yield msgpack.packb({
+            "type": "chunk",
+            "columns": {name: _pack_column(values) for name, values in chunk.items()},
+        })
+
+
+def iter_arrow(columns, metadata, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    Genera uno stream Arrow IPC: i metadati sono nello schema,
+    le righe in un record batch per ogni blocco
+    """
+    arrays = {}
+    for name, values in columns.items():
+        if values.dtype == object:
+            arrays[name] = pa.array(values, from_pandas=True)
+        else:
+            arrays[name] = pa.array(values)
+    schema = pa.schema([(name, array.type) for name, array in arrays.items()],
+                       metadata={"cleanai": json.dumps(metadata, default=_json_default)})
+    table = pa.Table.from_arrays(list(arrays.values()), schema=schema)
+
+    sink = io.BytesIO()
+
+    def drain():
+        data = sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+        return data
+
+    with pa.ipc.new_stream(sink, schema) as writer:
+        for batch in table.to_batches(max_chunksize=chunk_rows):
+            writer.write_batch(batch)
+            # Ogni blocco viene inviato appena scritto, insieme allo schema per il primo
+            yield drain()
+    tail = drain()
+    if tail:
+        yield tail
+
+
+def iter_encoded(media_type, columns, metadata, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    Restituisce il generatore di byte per il formato richiesto
+    """
+    if media_type == MSGPACK:
+        return iter_msgpack(columns, metadata, chunk_rows)
+    if media_type == ARROW:
+        return iter_arrow(columns, metadata, chunk_rows)
+    raise ValueError(f"Formato non supportato: {media_type}")
+
+
+def _synthetic_batch(num_detections, num_images, seed=42):
+    rng = np.random.default_rng(seed)
+    classes = ['clean_surface', 'dirty_surface', 'dust', 'stain', 'liquid_spill', 'trash', 'scratch', 'mold']
+    x1 = rng.uniform(0, 600, num_detections).astype(np.float32)
+    y1 = rng.uniform(0, 600, num_detections).astype(np.float32)
+    return {
+        "classes": classes,
+        "image_index": np.sort(rng.integers(0, num_images, num_detections)).astype(np.int32),
+        "label_id": rng.integers(0, len(classes), num_detections).astype(np.int16),
+        "score": rng.uniform(0.3, 1.0, num_detections).astype(np.float32),
+        "box": np.stack([x1, y1, x1 + 40, y1 + 40], axis=1),
+        "cleanliness_score": rng.uniform(0, 1, num_images).astype(np.float32),
+        "error": [None] * num_images,
+        "triage_verdict": [None] * num_images,
+        "simulated": True,
+    }
+
+
+def _synthetic_schedule(num_rows, seed=42):
+    rng = np.random.default_rng(seed)
+    schedule_df = pd.DataFrame({
+        "task_id": [f"task-{i}" for i in range(num_rows)],
+        "location_id": [f"loc-{i % 50}" for i in range(num_rows)],
+        "staff_index": rng.integers(0, 20, num_rows).astype(np.int32),
+        "scheduled_at": pd.Timestamp("2024-01-01 08:00") + pd.to_timedelta(rng.integers(0, 7 * 24 * 60, num_rows), unit="m"),
+        "estimated_duration": rng.uniform(30, 180, num_rows),
+        "expected_quality": rng.uniform(0.6, 0.95, num_rows),
+        "priority": rng.choice(["low", "medium", "high", "urgent"], num_rows),
+    })
+    return schedule_df, {"total_tasks": num_rows, "scheduled_tasks": num_rows}
+
+
+def _measure(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        size = fn()
+        timings.append(time.perf_counter() - start)
+    return size, float(np.median(timings)) * 1000
+
+
+def benchmark(num_detections=200000, num_images=2000, schedule_rows=50000, repeat=3):
+    """
+    Confronta dimensione e tempo di serializzazione dei formati disponibili
+
+    Returns:
+        Dizionario risultato -> formato -> (byte, millisecondi)
+    """
+    batch = _synthetic_batch(num_detections, num_images)
+    schedule_df, summary = _synthetic_schedule(schedule_rows)
+    results = {"analysis": {}, "schedule": {}}
+
+    # JSON: come oggi, costruendo un dizionario per riga
+    results["analysis"]["json"] = _measure(lambda: len(json.dumps(batch_to_json(batch)).encode()), repeat)
+
+    def schedule_json():
+        records = schedule_df.assign(scheduled_at=schedule_df["scheduled_at"].map(lambda ts: ts.isoformat()))
+        return len(json.dumps({"schedule": records.to_dict("records"), **summary}, default=_json_default).encode())
+
+    results["schedule"]["json"] = _measure(schedule_json, repeat)
+
+    for media_type, name in ((MSGPACK, "msgpack"), (ARROW, "arrow")):
+        if media_type not in available_formats():
+            continue
+        columns, metadata = batch_columns(batch)
+        results["analysis"][name] = _measure(
+            lambda: sum(len(chunk) for chunk in iter_encoded(media_type, columns, metadata)), repeat)
+        results["schedule"][name] = _measure(
+            lambda: sum(len(chunk) for chunk in iter_encoded(media_type, *schedule_columns(schedule_df, summary))),
+            repeat)
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Confronto dei formati di risposta di CleanAI")
+    parser.add_argument("--detections", type=int, default=200000)
+    parser.add_argument("--images", type=int, default=2000)
+    parser.add_argument("--schedule-rows", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    results = benchmark(args.detections, args.images, args.schedule_rows, args.repeat)
+    for result, formats in results.items():
+        json_size = formats["json"][0]
+        print(f"\n[{result}]")
+        for name, (size, ms) in formats.items():
+            print(f"  {name:8s} {size / 1024:10.1f} KB ({size / json_size * 100:5.1f}% del JSON)  {ms:8.1f} ms")
@@ -2,28 +2,47 @@
 # Questo file contiene l'implementazione del modello di computer vision per l'analisi delle superfici
 
 import os
+import time
 import cv2
 import numpy as np
 import torch
 from super_gradients.training import models
 from PIL import Image
+from checkpoint_format import is_safetensors_checkpoint, load_surface_model
+import change_regions
+
+# Pixel in ingresso al modello per un confronto sulle immagini intere (due foto 640x640)
+FULL_INFERENCE_PIXELS = 2 * 640 * 640
 
 class SurfaceAnalyzer:
-    def __init__(self, model_path=None):
+    def __init__(self, model_path=None, triage=None):
         """
         Inizializza l'analizzatore di superfici con YOLO-NAS
         
         Args:
             model_path: Percorso al modello pre-addestrato (opzionale)
+            triage: Cascata di triage da eseguire prima del modello (opzionale)
         """
+        self.triage = triage
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         print(f"Utilizzo dispositivo: {self.device}")
         
+        # Classi per il rilevamento di sporco e superfici
+        self.classes = [
+            'clean_surface', 'dirty_surface', 'dust', 'stain', 
+            'liquid_spill', 'trash', 'scratch', 'mold'
+        ]
+        
         # Carica il modello YOLO-NAS
         try:
-            if model_path and os.path.exists(model_path):
+            if model_path and os.path.exists(model_path) and is_safetensors_checkpoint(model_path):
+                # Checkpoint safetensors: pesi mappati in memoria e letti pigramente
+                self.model, self.classes = load_surface_model(model_path, self.device, self.classes)
+                print(f"Modello caricato da {model_path}")
+            elif model_path and os.path.exists(model_path):
                 # Carica un modello personalizzato se specificato
-                self.model = torch.load(model_path, map_location=self.device)
+                # Modello serializzato per intero: richiede weights_only=False (solo file fidati)
+                self.model = torch.load(model_path, map_location=self.device, weights_only=False)
                 print(f"Modello caricato da {model_path}")
             else:
                 # Altrimenti usa il modello pre-addestrato
@@ -35,12 +54,6 @@ class SurfaceAnalyzer:
             # Imposta il modello in modalità valutazione
             self.model.eval()
             
-            # Classi per il rilevamento di sporco e superfici
-            self.classes = [
-                'clean_surface', 'dirty_surface', 'dust', 'stain', 
-                'liquid_spill', 'trash', 'scratch', 'mold'
-            ]
-            
             print("Inizializzazione SurfaceAnalyzer completata")
         except Exception as e:
             print(f"Errore nell'inizializzazione del modello: {e}")
@@ -60,39 +73,80 @@ class SurfaceAnalyzer:
             Immagine preprocessata
         """
         try:
-            # Carica l'immagine
-            if isinstance(image_path, str):
-                image = cv2.imread(image_path)
-                image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            else:
-                # Supporta anche array numpy o oggetti PIL
-                if isinstance(image_path, np.ndarray):
-                    image = image_path
-                    if image.shape[2] == 3:
-                        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-                elif isinstance(image_path, Image.Image):
-                    image = np.array(image_path)
-                else:
-                    raise ValueError("Formato immagine non supportato")
-            
-            # Ridimensiona l'immagine a 640x640 (dimensione standard per YOLO)
-            image_resized = cv2.resize(image, (640, 640))
-            
-            # Normalizza i valori dei pixel
-            image_normalized = image_resized / 255.0
-            
-            # Converte in tensore PyTorch
-            if self.model is not None:
-                image_tensor = torch.from_numpy(image_normalized).permute(2, 0, 1).float().unsqueeze(0)
-                image_tensor = image_tensor.to(self.device)
-                return image_tensor, image
-            else:
-                return image_normalized, image
-                
+            image = self._load_image(image_path)
+            return self._prepare_image(image)
         except Exception as e:
             print(f"Errore nel preprocessamento dell'immagine: {e}")
             return None, None
     
+    def decode_image(self, source):
+        """
+        Decodifica un'immagine codificata (JPEG, PNG...) o la carica in formato RGB
+        
+        Args:
+            source: Byte dell'immagine codificata, percorso, array numpy (BGR) o oggetto PIL
+            
+        Returns:
+            Immagine RGB come array numpy
+        """
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            image = cv2.imdecode(np.frombuffer(source, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if image is None:
+                raise ValueError("Immagine non valida")
+            return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        return self._load_image(source)
+    
+    def _load_image(self, image_path):
+        """
+        Carica l'immagine in formato RGB
+        
+        Args:
+            image_path: Percorso all'immagine, array numpy (BGR) o oggetto PIL
+            
+        Returns:
+            Immagine RGB come array numpy
+        """
+        if isinstance(image_path, str):
+            image = cv2.imread(image_path)
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        else:
+            # Supporta anche array numpy o oggetti PIL
+            if isinstance(image_path, np.ndarray):
+                image = image_path
+                if image.shape[2] == 3:
+                    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+            elif isinstance(image_path, Image.Image):
+                image = np.array(image_path)
+            else:
+                raise ValueError("Formato immagine non supportato")
+        
+        return image
+    
+    def _prepare_image(self, image, resize=True):
+        """
+        Ridimensiona e normalizza un'immagine RGB per il modello
+        
+        Args:
+            image: Immagine RGB come array numpy
+            resize: Se False l'immagine, già con lati multipli di 32, mantiene la sua dimensione
+            
+        Returns:
+            Tupla (immagine preprocessata, immagine originale)
+        """
+        # Ridimensiona l'immagine a 640x640 (dimensione standard per YOLO)
+        image_resized = cv2.resize(image, (640, 640)) if resize else image
+        
+        # Normalizza i valori dei pixel
+        image_normalized = image_resized / 255.0
+        
+        # Converte in tensore PyTorch
+        if self.model is not None:
+            image_tensor = torch.from_numpy(image_normalized).permute(2, 0, 1).float().unsqueeze(0)
+            image_tensor = image_tensor.to(self.device)
+            return image_tensor, image
+        else:
+            return image_normalized, image
+    
     def analyze_surface(self, image_path):
         """
         Analizza una superficie per rilevare sporco e problemi
@@ -104,67 +158,338 @@ class SurfaceAnalyzer:
             Dizionario con i risultati dell'analisi
         """
         try:
-            # Preprocessa l'immagine
-            processed_image, original_image = self.preprocess_image(image_path)
-            
-            if processed_image is None:
+            # Carica l'immagine
+            try:
+                image = self.decode_image(image_path)
+            except Exception as e:
+                print(f"Errore nel preprocessamento dell'immagine: {e}")
                 return {"error": "Errore nel preprocessamento dell'immagine"}
             
-            # Se siamo in modalità simulazione, genera risultati simulati
-            if self.model is None:
-                return self._simulate_analysis(original_image)
-            
-            # Esegui l'inferenza
-            with torch.no_grad():
-                predictions = self.model.predict(processed_image)
-            
-            # Estrai i risultati
-            boxes = predictions.prediction.bboxes_xyxy
-            scores = predictions.prediction.confidence
-            labels = predictions.prediction.labels
-            
-            # Converti in lista di dizionari
-            detections = []
-            for i in range(len(boxes)):
-                box = boxes[i].cpu().numpy()
-                score = float(scores[i])
-                label_idx = int(labels[i])
-                label = self.classes[label_idx] if label_idx < len(self.classes) else f"class_{label_idx}"
-                
-                detections.append({
-                    "box": box.tolist(),
-                    "score": score,
-                    "label": label
-                })
+            return self._analyze_decoded(image)
             
-            # Calcola il punteggio di pulizia
-            cleanliness_score = self._calculate_cleanliness_score(detections)
+        except Exception as e:
+            print(f"Errore nell'analisi della superficie: {e}")
+            return {"error": str(e)}
+    
+    def _analyze_decoded(self, image):
+        """
+        Analizza un'immagine RGB già decodificata, passando prima dalla cascata di triage
+        """
+        triage, triage_result = self._run_triage(image)
+        if triage_result is not None:
+            return triage_result
+        
+        return self._with_triage(triage, self._analyze_image(image))
+    
+    def _run_triage(self, image):
+        """
+        Triage economico: le immagini chiaramente pulite o inutilizzabili
+        non passano dal modello neurale
+        
+        Returns:
+            Tupla (risultato del triage, risultato finale se il modello non serve)
+        """
+        if self.triage is None:
+            return None, None
+        triage = self.triage.evaluate(image)
+        if triage["verdict"] != "uncertain" and not triage["audit"]:
+            return triage, self.triage.build_result(triage, self._generate_analysis_summary)
+        return triage, None
+    
+    def _with_triage(self, triage, result):
+        """
+        Registra il confronto di calibrazione e allega il triage al risultato del modello
+        """
+        if triage is not None:
+            self.triage.record_audit(triage, result)
+            result["triage"] = triage
+        return result
+    
+    def analyze_batch(self, images):
+        """
+        Analizza più immagini restituendo le rilevazioni in forma colonnare,
+        senza costruire un dizionario per ogni rilevazione
+        
+        Args:
+            images: Lista di immagini (percorsi, array numpy o oggetti PIL)
             
-            return {
-                "detections": detections,
-                "cleanliness_score": cleanliness_score,
-                "analysis_summary": self._generate_analysis_summary(detections, cleanliness_score)
-            }
+        Returns:
+            Dizionario di colonne: per rilevazione image_index, label_id, score e box (N x 4);
+            per immagine cleanliness_score (NaN in caso di errore), error e triage_verdict
+        """
+        return self._batch_from_outcomes([self._analyze_batch_item(image) for image in images])
+    
+    def _analyze_batch_item(self, image_path):
+        """
+        Analizza un'immagine del batch
+        
+        Returns:
+            Dizionario con arrays (o None), error e triage_verdict
+        """
+        triage = None
+        try:
+            image = self._load_image(image_path)
+            triage, result = self._run_triage(image)
+            if result is not None:
+                return self._triage_outcome(triage, result)
+            processed_image, original_image = self._prepare_image(image)
+            return self._arrays_outcome(triage, self._infer(processed_image, original_image))
+        except Exception as e:
+            print(f"Errore nell'analisi dell'immagine: {e}")
+            return {"arrays": None, "error": str(e), "triage_verdict": triage["verdict"] if triage else None}
+    
+    def _triage_outcome(self, triage, result):
+        """
+        Esito per il batch di un'immagine decisa dalla cascata di triage
+        """
+        if "error" in result:
+            return {"arrays": None, "error": result["error"], "triage_verdict": triage["verdict"]}
+        arrays = self._detections_to_arrays(result["detections"])
+        arrays["cleanliness_score"] = result["cleanliness_score"]
+        return {"arrays": arrays, "error": None, "triage_verdict": triage["verdict"]}
+    
+    def _arrays_outcome(self, triage, raw):
+        """
+        Esito per il batch di un'immagine analizzata dal modello
+        """
+        arrays = self._postprocess_arrays(raw)
+        if triage is not None:
+            self.triage.record_audit(triage, arrays)
+        return {"arrays": arrays, "error": None, "triage_verdict": triage["verdict"] if triage else None}
+    
+    def _batch_from_outcomes(self, outcomes):
+        """
+        Riunisce gli esiti per immagine nelle colonne restituite da analyze_batch
+        """
+        image_index, label_ids, scores, boxes = [], [], [], []
+        cleanliness_scores = np.full(len(outcomes), np.nan, dtype=np.float32)
+        
+        for i, outcome in enumerate(outcomes):
+            arrays = outcome["arrays"]
+            if arrays is None:
+                continue
+            count = len(arrays["scores"])
+            image_index.append(np.full(count, i, dtype=np.int32))
+            label_ids.append(arrays["label_ids"])
+            scores.append(arrays["scores"])
+            boxes.append(arrays["boxes"])
+            cleanliness_scores[i] = arrays["cleanliness_score"]
+        
+        return {
+            "classes": list(self.classes),
+            "image_index": np.concatenate(image_index) if image_index else np.zeros(0, dtype=np.int32),
+            "label_id": np.concatenate(label_ids) if label_ids else np.zeros(0, dtype=np.int16),
+            "score": np.concatenate(scores) if scores else np.zeros(0, dtype=np.float32),
+            "box": np.concatenate(boxes) if boxes else np.zeros((0, 4), dtype=np.float32),
+            "cleanliness_score": cleanliness_scores,
+            "error": [outcome["error"] for outcome in outcomes],
+            "triage_verdict": [outcome["triage_verdict"] for outcome in outcomes],
+            "simulated": self.model is None
+        }
+    
+    def _detect_arrays(self, processed_image):
+        """
+        Esegue l'inferenza e restituisce le rilevazioni come array numpy
+        
+        Returns:
+            Tupla (box N x 4, punteggi N, indici di classe N)
+        """
+        with torch.no_grad():
+            predictions = self.model.predict(processed_image)
+        
+        prediction = predictions.prediction
+        
+        def to_numpy(values):
+            return values.cpu().numpy() if hasattr(values, "cpu") else np.asarray(values)
+        
+        boxes = to_numpy(prediction.bboxes_xyxy).astype(np.float32).reshape(-1, 4)
+        scores = to_numpy(prediction.confidence).astype(np.float32).reshape(-1)
+        label_ids = to_numpy(prediction.labels).astype(np.int16).reshape(-1)
+        return boxes, scores, label_ids
+    
+    def _analyze_image_arrays(self, image):
+        """
+        Come _analyze_image, ma restituisce le rilevazioni come array numpy
+        
+        Returns:
+            Dizionario con boxes, scores, label_ids e cleanliness_score
+        """
+        processed_image, original_image = self._prepare_image(image)
+        return self._postprocess_arrays(self._infer(processed_image, original_image))
+    
+    def _infer(self, processed_image, original_image):
+        """
+        Fase di inferenza: esegue il modello su un'immagine già preprocessata
+        
+        Returns:
+            Dizionario con boxes, scores e label_ids, oppure il risultato
+            completo della simulazione se il modello non è disponibile
+        """
+        if self.model is None:
+            return self._simulate_analysis(original_image)
+        
+        boxes, scores, label_ids = self._detect_arrays(processed_image)
+        return {"boxes": boxes, "scores": scores, "label_ids": label_ids}
+    
+    def _postprocess(self, raw):
+        """
+        Fase di post-elaborazione: rilevazioni, punteggio di pulizia e riepilogo
+        
+        Args:
+            raw: Risultato di _infer
+            
+        Returns:
+            Dizionario nello stesso formato di analyze_surface
+        """
+        if "detections" in raw or "error" in raw:
+            # Risultato già completo (simulazione)
+            return raw
+        
+        # Converti in lista di dizionari
+        detections = []
+        for box, score, label_idx in zip(raw["boxes"], raw["scores"].tolist(), raw["label_ids"].tolist()):
+            label = self.classes[label_idx] if label_idx < len(self.classes) else f"class_{label_idx}"
+            
+            detections.append({
+                "box": box.tolist(),
+                "score": score,
+                "label": label
+            })
+        
+        # Calcola il punteggio di pulizia
+        cleanliness_score = self._calculate_cleanliness_score(detections)
+        
+        return {
+            "detections": detections,
+            "cleanliness_score": cleanliness_score,
+            "analysis_summary": self._generate_analysis_summary(detections, cleanliness_score)
+        }
+    
+    def _postprocess_arrays(self, raw):
+        """
+        Come _postprocess, ma mantiene le rilevazioni come array numpy
+        """
+        if "error" in raw:
+            raise ValueError(raw["error"])
+        if "detections" in raw:
+            arrays = self._detections_to_arrays(raw["detections"])
+            arrays["cleanliness_score"] = raw["cleanliness_score"]
+            return arrays
+        
+        return {
+            **raw,
+            "cleanliness_score": self._cleanliness_from_arrays(raw["scores"], raw["label_ids"])
+        }
+    
+    def _detections_to_arrays(self, detections):
+        """
+        Converte una lista di rilevazioni in array numpy
+        """
+        label_ids = []
+        for detection in detections:
+            label = detection["label"]
+            if label in self.classes:
+                label_ids.append(self.classes.index(label))
+            elif str(label).startswith("class_"):
+                label_ids.append(int(str(label)[len("class_"):]))
+            else:
+                label_ids.append(-1)
+        
+        return {
+            "boxes": np.array([d["box"] for d in detections], dtype=np.float32).reshape(-1, 4),
+            "scores": np.array([d["score"] for d in detections], dtype=np.float32),
+            "label_ids": np.array(label_ids, dtype=np.int16)
+        }
+    
+    def _cleanliness_from_arrays(self, scores, label_ids):
+        """
+        Stessa formula di _calculate_cleanliness_score, calcolata sugli array
+        """
+        if len(scores) == 0:
+            return 1.0
+        dirt = label_ids != self.classes.index('clean_surface')
+        dirt_count = int(dirt.sum())
+        if dirt_count == 0:
+            return 1.0
+        base_score = 1.0 - float(scores[dirt].sum()) / len(scores)
+        penalty = min(0.5, dirt_count * 0.1)
+        return max(0.0, base_score - penalty)
+    
+    def _analyze_image(self, image, resize=True):
+        """
+        Esegue l'analisi con il modello neurale su un'immagine RGB già caricata
+        
+        Args:
+            image: Immagine RGB come array numpy
+            resize: Se False l'immagine viene passata al modello alla sua dimensione
+            
+        Returns:
+            Dizionario con i risultati dell'analisi
+        """
+        try:
+            # Preprocessa l'immagine
+            processed_image, original_image = self._prepare_image(image, resize)
+            
+            # Esegui l'inferenza (o la simulazione) e costruisci il risultato
+            return self._postprocess(self._infer(processed_image, original_image))
             
         except Exception as e:
             print(f"Errore nell'analisi della superficie: {e}")
             return {"error": str(e)}
     
-    def compare_before_after(self, before_image_path, after_image_path):
+    def compare_before_after(self, before_image_path, after_image_path, mode="full", region_params=None):
         """
         Confronta le immagini prima e dopo la pulizia
         
         Args:
             before_image_path: Percorso all'immagine prima della pulizia
             after_image_path: Percorso all'immagine dopo la pulizia
+            mode: "full" analizza le immagini intere, "regions" solo le regioni cambiate
+                più un campione di quelle invariate
+            region_params: Parametri da sovrascrivere rispetto a change_regions.DEFAULT_PARAMS
             
+        Returns:
+            Dizionario con i risultati del confronto
+        """
+        # Stessa validazione per entrambe le modalità: un'immagine non decodificabile è un errore del client
+        try:
+            before = self.decode_image(before_image_path)
+            after = self.decode_image(after_image_path)
+        except Exception as e:
+            print(f"Errore nel caricamento delle immagini: {e}")
+            return {"error": str(e), "invalid": True}
+        
+        if mode == "regions":
+            return self._compare_regions(before, after, region_params)
+        return self._compare_full(before, after)
+    
+    def _compare_full(self, before, after):
+        """
+        Confronto sulle immagini intere già decodificate
+        
+        Args:
+            before: Immagine RGB prima della pulizia
+            after: Immagine RGB dopo la pulizia
+        
         Returns:
             Dizionario con i risultati del confronto
         """
         try:
             # Analizza entrambe le immagini
-            before_analysis = self.analyze_surface(before_image_path)
-            after_analysis = self.analyze_surface(after_image_path)
+            start = time.perf_counter()
+            before_analysis = self._analyze_decoded(before)
+            after_analysis = self._analyze_decoded(after)
+            inference_ms = (time.perf_counter() - start) * 1000
+            
+            # Un'immagine scartata dal triage resta un errore del client, come in analyze_surface
+            for name, analysis in (("before", before_analysis), ("after", after_analysis)):
+                if analysis.get("unusable"):
+                    return {
+                        "error": f"Immagine {name} non utilizzabile ({analysis['triage']['reason']})",
+                        "unusable": True,
+                        "image": name,
+                        "reason": analysis["triage"]["reason"],
+                    }
             
             if "error" in before_analysis or "error" in after_analysis:
                 return {"error": "Errore nell'analisi delle immagini"}
@@ -181,7 +506,9 @@ class SurfaceAnalyzer:
                 "improvement_percentage": improvement_percentage,
                 "before_detections": before_analysis["detections"],
                 "after_detections": after_analysis["detections"],
-                "summary": self._generate_comparison_summary(before_analysis, after_analysis)
+                "summary": self._generate_comparison_summary(before_analysis, after_analysis),
+                "inference_pixels": FULL_INFERENCE_PIXELS,
+                "inference_ms": inference_ms
             }
             
             return comparison_report
@@ -190,6 +517,118 @@ class SurfaceAnalyzer:
             print(f"Errore nel confronto delle immagini: {e}")
             return {"error": str(e)}
     
+    def _compare_regions(self, before, after, params=None):
+        """
+        Confronto per regioni: allinea le foto, individua le zone cambiate
+        ed esegue il modello solo su quelle e su un campione delle zone invariate
+        
+        Args:
+            before: Immagine RGB prima della pulizia
+            after: Immagine RGB dopo la pulizia
+            params: Parametri da sovrascrivere rispetto a change_regions.DEFAULT_PARAMS
+        
+        Returns:
+            Dizionario con i risultati del confronto e il dettaglio per regione
+        """
+        params = {**change_regions.DEFAULT_PARAMS, **(params or {})}
+        try:
+            aligned_after, alignment = change_regions.align_images(before, after, params)
+            mask, scale = change_regions.change_mask(before, aligned_after, params)
+            changed, changed_fraction = change_regions.change_regions(mask, scale, before.shape, params)
+            
+            if changed_fraction > params["max_changed_fraction"]:
+                # Quasi tutta la scena è cambiata: le regioni non farebbero risparmiare nulla
+                result = self._compare_full(before, after)
+                if "error" not in result:
+                    result.update({"mode": "full", "fallback_reason": "changed_fraction",
+                                   "changed_fraction": changed_fraction, "alignment": alignment})
+                return result
+            
+            # Seme dal contenuto: lo stesso report campiona sempre le stesse zone
+            rng = np.random.default_rng(int(mask.sum()) + before.shape[0] * before.shape[1])
+            unchanged = change_regions.sample_unchanged(before.shape, changed, params, rng)
+            
+            height, width = before.shape[:2]
+            total_area = float(height * width)
+            changed_area = sum(change_regions.box_area(box) for box in changed)
+            # Le zone invariate campionate rappresentano tutta l'area non cambiata
+            unchanged_weight = (total_area - changed_area) / len(unchanged) if unchanged else 0.0
+            
+            boxes = changed + unchanged
+            if not boxes:
+                return self._compare_full(before, after)
+            
+            # Un solo passaggio del modello per foto: le regioni sono disposte in un mosaico
+            # grande quanto le regioni, passato al modello senza riportarlo a 640x640
+            before_canvas, placements = change_regions.pack_regions(
+                before, boxes, params["canvas_size"], params["canvas_stride"])
+            after_canvas, _ = change_regions.pack_regions(
+                aligned_after, boxes, params["canvas_size"], params["canvas_stride"])
+            start = time.perf_counter()
+            before_result = self._analyze_image(before_canvas, resize=False)
+            after_result = self._analyze_image(after_canvas, resize=False)
+            inference_ms = (time.perf_counter() - start) * 1000
+            if "error" in before_result or "error" in after_result:
+                return {"error": "Errore nell'analisi delle regioni"}
+            before_regions = change_regions.unpack_detections(before_result["detections"], placements)
+            after_regions = change_regions.unpack_detections(after_result["detections"], placements)
+            
+            regions = []
+            before_detections, after_detections = [], []
+            weighted_before = weighted_after = total_weight = 0.0
+            for i, box in enumerate(boxes):
+                kind = "changed" if i < len(changed) else "unchanged_sample"
+                region_before, region_after = before_regions[i], after_regions[i]
+                before_detections.extend(region_before)
+                after_detections.extend(region_after)
+                
+                region_before_score = self._calculate_cleanliness_score(region_before)
+                region_after_score = self._calculate_cleanliness_score(region_after)
+                problems = change_regions.match_problems(region_before, region_after, params["match_iou"])
+                weight = change_regions.box_area(box) if kind == "changed" else unchanged_weight
+                weighted_before += region_before_score * weight
+                weighted_after += region_after_score * weight
+                total_weight += weight
+                
+                regions.append({
+                    "id": i + 1,
+                    "kind": kind,
+                    "box": box,
+                    "before_score": region_before_score,
+                    "after_score": region_after_score,
+                    "improvement": region_after_score - region_before_score,
+                    **problems,
+                })
+            
+            before_score = weighted_before / total_weight if total_weight else 1.0
+            after_score = weighted_after / total_weight if total_weight else 1.0
+            improvement = after_score - before_score
+            analyzed_area = sum(change_regions.box_area(region["box"]) for region in regions)
+            
+            return {
+                "mode": "regions",
+                "before_score": before_score,
+                "after_score": after_score,
+                "improvement": improvement,
+                "improvement_percentage": improvement * 100,
+                "before_detections": before_detections,
+                "after_detections": after_detections,
+                "regions": regions,
+                "changed_fraction": changed_fraction,
+                "alignment": alignment,
+                "inference_calls": 2,
+                # Costo reale dell'inferenza: pixel in ingresso al modello e tempo
+                "inference_pixels": before_canvas.shape[0] * before_canvas.shape[1] * 2,
+                "full_inference_pixels": FULL_INFERENCE_PIXELS,
+                "inference_ms": inference_ms,
+                "analyzed_area_fraction": analyzed_area / total_area,
+                "summary": self._generate_region_summary(before_score, after_score, regions)
+            }
+            
+        except Exception as e:
+            print(f"Errore nel confronto per regioni: {e}")
+            return {"error": str(e)}
+    
     def _calculate_cleanliness_score(self, detections):
         """
         Calcola un punteggio di pulizia basato sulle rilevazioni
@@ -276,27 +715,7 @@ class SurfaceAnalyzer:
         Returns:
             Riepilogo testuale
         """
-        before_score = before_analysis["cleanliness_score"]
-        after_score = after_analysis["cleanliness_score"]
-        improvement = after_score - before_score
-        improvement_percentage = improvement * 100
-        
-        if improvement_percentage >= 50:
-            quality = "eccellente"
-        elif improvement_percentage >= 30:
-            quality = "ottimo"
-        elif improvement_percentage >= 20:
-            quality = "buono"
-        elif improvement_percentage >= 10:
-            quality = "discreto"
-        elif improvement_percentage > 0:
-            quality = "minimo"
-        else:
-            quality = "nessun miglioramento"
-        
-        summary = f"Miglioramento {quality}: {improvement_percentage:.1f}%\n"
-        summary += f"Punteggio prima: {before_score:.2f}\n"
-        summary += f"Punteggio dopo: {after_score:.2f}\n\n"
+        summary = self._improvement_header(before_analysis["cleanliness_score"], after_analysis["cleanliness_score"])
         
         # Confronta i problemi rilevati
         before_problems = {d["label"]: d["score"] for d in before_analysis["detections"] if d["label"] != "clean_surface"}
@@ -323,6 +742,62 @@ class SurfaceAnalyzer:
         
         return summary
     
+    def _generate_region_summary(self, before_score, after_score, regions):
+        """
+        Genera un riepilogo testuale del confronto per regioni
+        
+        Args:
+            before_score: Punteggio complessivo prima
+            after_score: Punteggio complessivo dopo
+            regions: Dettaglio delle regioni analizzate
+            
+        Returns:
+            Riepilogo testuale
+        """
+        summary = self._improvement_header(before_score, after_score)
+        
+        def count_labels(detections):
+            counts = {}
+            for detection in detections:
+                counts[detection["label"]] = counts.get(detection["label"], 0) + 1
+            return ", ".join(f"{label} x{count}" for label, count in counts.items())
+        
+        for region in regions:
+            kind = "cambiata" if region["kind"] == "changed" else "invariata (campione)"
+            summary += (f"Regione {region['id']} {kind} {region['box']}: "
+                        f"{region['before_score']:.2f} -> {region['after_score']:.2f}\n")
+            for key, title in (("resolved", "risolti"), ("remaining", "rimanenti"), ("new", "nuovi")):
+                if region[key]:
+                    summary += f"  Problemi {title}: {count_labels(region[key])}\n"
+        
+        return summary
+    
+    def _improvement_header(self, before_score, after_score):
+        """
+        Intestazione del riepilogo con la valutazione del miglioramento
+        """
+        improvement = after_score - before_score
+        improvement_percentage = improvement * 100
+        
+        if improvement_percentage >= 50:
+            quality = "eccellente"
+        elif improvement_percentage >= 30:
+            quality = "ottimo"
+        elif improvement_percentage >= 20:
+            quality = "buono"
+        elif improvement_percentage >= 10:
+            quality = "discreto"
+        elif improvement_percentage > 0:
+            quality = "minimo"
+        else:
+            quality = "nessun miglioramento"
+        
+        summary = f"Miglioramento {quality}: {improvement_percentage:.1f}%\n"
+        summary += f"Punteggio prima: {before_score:.2f}\n"
+        summary += f"Punteggio dopo: {after_score:.2f}\n\n"
+        
+        return summary
+    
     def _simulate_analysis(self, image):
         """
         Simula un'analisi per scopi dimostrativi
@@ -364,8 +839,8 @@ class SurfaceAnalyzer:
             num_detections = int((1 - cleanliness_score) * 10)
             for i in range(num_detections):
                 # Genera box casuali
-                x1 = np.random.randint(0, image.shape[1] - 100)
-                y1 = np.random.randint(0, image.shape[0] - 100)
+                x1 = np.random.randint(0, max(1, image.shape[1] - 100))
+                y1 = np.random.randint(0, max(1, image.shape[0] - 100))
                 x2 = x1 + np.random.randint(50, 100)
                 y2 = y1 + np.random.randint(50, 100)
                 
@@ -383,8 +858,8 @@ class SurfaceAnalyzer:
                 })
         
         # Aggiungi sempre almeno una rilevazione di superficie pulita
-        x1 = np.random.randint(0, image.shape[1] - 200)
-        y1 = np.random.randint(0, image.shape[0] - 200)
+        x1 = np.random.randint(0, max(1, image.shape[1] - 200))
+        y1 = np.random.randint(0, max(1, image.shape[0] - 200))
         x2 = x1 + np.random.randint(150, 200)
         y2 = y1 + np.random.randint(150, 200)
         
@@ -418,4 +893,28 @@ def visualize_results(image_path, analysis_results, output_path=None):
         # Carica l'immagine
         if isinstance(image_path, str):
             image = cv2.imread(image_path)
-<response clipped><NOTE>To save on context only part of this file has been shown to you. You should retry this tool after you have searched inside the file with `grep -n` in order to find the line numbers of what you are looking for.</NOTE>
\ No newline at end of file
+        else:
+            image = image_path.copy()
+        
+        # Disegna i box delle rilevazioni
+        for detection in analysis_results.get("detections", []):
+            x1, y1, x2, y2 = [int(v) for v in detection["box"]]
+            color = (0, 255, 0) if detection["label"] == "clean_surface" else (0, 0, 255)
+            cv2.rectangle(image, (x1, y1), (x2, y2), color, 2)
+            cv2.putText(image, f"{detection['label']} {detection['score']:.2f}", (x1, max(0, y1 - 5)),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1)
+        
+        # Aggiungi il punteggio di pulizia
+        if "cleanliness_score" in analysis_results:
+            cv2.putText(image, f"Pulizia: {analysis_results['cleanliness_score']:.2f}", (10, 30),
+                        cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+        
+        # Salva l'immagine se richiesto
+        if output_path:
+            cv2.imwrite(output_path, image)
+        
+        return image
+        
+    except Exception as e:
+        print(f"Errore nella visualizzazione dei risultati: {e}")
+        return None
@@ -0,0 +1,314 @@
+# Addestramento parallelo di modelli per sede (o cliente) con ricerca degli iperparametri
+# Ogni combinazione gruppo x iperparametri viene addestrata in un processo separato,
+# con un numero limitato di thread PyTorch per processo. Per ogni gruppo viene scelto il
+# modello con la loss di validazione più bassa; il modello di un gruppo viene tenuto solo se
+# batte il modello globale sulle stesse righe di validazione del gruppo. Viene scritto un
+# indice versionato che OperationalOptimizer.load_model accetta al posto di un singolo checkpoint.
+#
+# Esempio:
+#   python training_orchestrator.py --data storico.csv --output modelli/ --group-by location_id
+# dove storico.csv contiene le colonne delle feature e actual_duration, quality_score, priority_score.
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import product
+
+import numpy as np
+import pandas as pd
+
+GLOBAL_GROUP = "__global__"
+
+DEFAULT_TARGET_COLUMNS = ("actual_duration", "quality_score", "priority_score")
+
+DEFAULT_PARAM_GRID = {
+    "hidden_size": [16, 32, 64],
+    "learning_rate": [0.001, 0.005],
+    "epochs": [100, 300],
+}
+
+
+def _init_worker(threads):
+    # Limita i thread di ogni processo perché la somma non superi i core disponibili
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    os.environ["MKL_NUM_THREADS"] = str(threads)
+    import torch
+    torch.set_num_threads(threads)
+
+
+def _train_candidate(job):
+    """
+    Addestra un candidato in un processo del pool
+
+    Args:
+        job: Dizionario con gruppo, iperparametri, dati, target e percorso di salvataggio
+
+    Returns:
+        Dizionario con loss di validazione e tempo di addestramento (loss None se fallito)
+    """
+    from operational_optimizer import OperationalOptimizer
+
+    start = time.perf_counter()
+    optimizer = OperationalOptimizer()
+    params = job["params"]
+    history = optimizer.train_model(job["data"], job["targets"], epochs=params["epochs"],
+                                    learning_rate=params["learning_rate"], hidden_size=params["hidden_size"])
+
+    val_loss = None
+    if history and history["val_loss"] and np.isfinite(history["val_loss"][-1]):
+        val_loss = float(history["val_loss"][-1])
+        optimizer.save_model(job["path"])
+
+    return {
+        "group": job["group"],
+        "params": params,
+        "path": job["path"],
+        "val_loss": val_loss,
+        "train_seconds": time.perf_counter() - start,
+    }
+
+
+def global_loss_on_group(global_path, frame, target_columns):
+    """
+    Calcola la loss del modello globale sulle righe di validazione di un gruppo
+
+    Args:
+        global_path: Checkpoint del modello globale
+        frame: DataFrame del gruppo con feature e target
+        target_columns: Colonne target
+
+    Returns:
+        Errore quadratico medio sulle righe di validazione (None se non calcolabile)
+    """
+    from sklearn.model_selection import train_test_split
+    from operational_optimizer import OperationalOptimizer
+
+    optimizer = OperationalOptimizer()
+    if not optimizer.load_model(global_path):
+        return None
+    X = optimizer.preprocess_data(frame.drop(columns=target_columns))
+    if X is None:
+        return None
+    y = frame[target_columns].to_numpy(dtype=np.float64)
+
+    # Stessa suddivisione di train_model: le righe di validazione sono quelle del candidato del gruppo
+    _, val_idx = train_test_split(np.arange(len(X)), test_size=0.2, random_state=42)
+    predictions = optimizer._forward(X[val_idx])
+    loss = float(np.mean((predictions - y[val_idx]) ** 2))
+    return loss if np.isfinite(loss) else None
+
+
+def expand_grid(param_grid):
+    """
+    Restituisce tutte le combinazioni di iperparametri della griglia
+    """
+    names = sorted(param_grid)
+    return [dict(zip(names, values)) for values in product(*(param_grid[name] for name in names))]
+
+
+def read_index(index_path):
+    if not os.path.exists(index_path):
+        return {"current": None, "versions": {}}
+    with open(index_path) as f:
+        return json.load(f)
+
+
+def write_index(index_path, index):
+    # Scrittura atomica: il server può rileggere l'indice in qualsiasi momento
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f, indent=2)
+    os.replace(tmp_path, index_path)
+
+
+class TrainingOrchestrator:
+    """
+    Addestra e seleziona un modello per ogni sede o cliente
+    """
+
+    def __init__(self, output_dir, group_by="location_id", param_grid=None, target_columns=DEFAULT_TARGET_COLUMNS,
+                 min_samples=50, processes=None, threads_per_worker=None):
+        """
+        Inizializza l'orchestratore
+
+        Args:
+            output_dir: Cartella dei modelli e dell'indice (index.json)
+            group_by: Colonna che identifica il gruppo (location_id o client_id)
+            param_grid: Griglia di iperparametri (hidden_size, learning_rate, epochs)
+            target_columns: Colonne con durata, qualità e priorità osservate
+            min_samples: Campioni minimi per addestrare un modello dedicato al gruppo;
+                i gruppi più piccoli usano il modello globale
+            processes: Processi paralleli (di default uno per core)
+            threads_per_worker: Thread PyTorch per processo (di default core / processi)
+        """
+        self.output_dir = output_dir
+        self.group_by = group_by
+        self.param_grid = param_grid or DEFAULT_PARAM_GRID
+        self.target_columns = list(target_columns)
+        self.min_samples = min_samples
+
+        cpu_count = os.cpu_count() or 1
+        self.processes = max(1, processes or cpu_count)
+        self.threads_per_worker = max(1, threads_per_worker or cpu_count // self.processes)
+
+    @property
+    def index_path(self):
+        return os.path.join(self.output_dir, "index.json")
+
+    def _groups(self, data):
+        groups = {GLOBAL_GROUP: data}
+        if self.group_by not in data:
+            print(f"Colonna {self.group_by} assente: viene addestrato solo il modello globale")
+            return groups, []
+
+        skipped = []
+        for group, frame in data.groupby(data[self.group_by].astype(str)):
+            if len(frame) < self.min_samples:
+                skipped.append(group)
+                continue
+            groups[group] = frame
+        return groups, skipped
+
+    def run(self, data, activate=True):
+        """
+        Addestra tutti i candidati e aggiunge una nuova versione all'indice
+
+        Args:
+            data: DataFrame con feature, colonna di raggruppamento e target
+            activate: Se True la nuova versione diventa quella corrente dell'indice
+
+        Returns:
+            Voce dell'indice per la nuova versione
+        """
+        start = time.perf_counter()
+        missing = [column for column in self.target_columns if column not in data]
+        if missing:
+            raise ValueError(f"Colonne target mancanti: {missing}")
+
+        version = f"{datetime.now():%Y%m%d%H%M%S}-{uuid.uuid4().hex[:6]}"
+        version_dir = os.path.join(self.output_dir, version)
+        candidates_dir = os.path.join(version_dir, "candidates")
+        os.makedirs(candidates_dir, exist_ok=True)
+
+        try:
+            groups, skipped = self._groups(data)
+            grid = expand_grid(self.param_grid)
+
+            jobs = []
+            for g, (group, frame) in enumerate(groups.items()):
+                for c, params in enumerate(grid):
+                    jobs.append({
+                        "group": group,
+                        "params": params,
+                        "data": frame.drop(columns=self.target_columns),
+                        "targets": frame[self.target_columns].to_numpy(dtype=np.float64),
+                        "path": os.path.join(candidates_dir, f"g{g}_c{c}.safetensors"),
+                    })
+
+            print(f"Addestramento di {len(jobs)} candidati ({len(groups)} gruppi x {len(grid)} combinazioni) "
+                  f"su {self.processes} processi da {self.threads_per_worker} thread")
+
+            # spawn: PyTorch non è sicuro dopo un fork con thread già avviati
+            with ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context("spawn"),
+                                     initializer=_init_worker, initargs=(self.threads_per_worker,)) as pool:
+                results = list(pool.map(_train_candidate, jobs))
+
+            # Miglior candidato per gruppo secondo la loss di validazione
+            best = {}
+            for result in results:
+                if result["val_loss"] is None:
+                    continue
+                current = best.get(result["group"])
+                if current is None or result["val_loss"] < current["val_loss"]:
+                    best[result["group"]] = result
+
+            if GLOBAL_GROUP not in best:
+                raise RuntimeError("Addestramento del modello globale fallito")
+
+            models = {}
+            global_preferred = []
+            for g, (group, frame) in enumerate(groups.items()):
+                result = best.get(group)
+                if result is None:
+                    print(f"Nessun candidato valido per {group}: si userà il modello globale")
+                    continue
+
+                global_loss = None
+                if group != GLOBAL_GROUP:
+                    # Il modello globale ha visto parte di queste righe in addestramento:
+                    # il confronto lo favorisce, quindi il modello del gruppo resta solo se lo batte
+                    global_loss = global_loss_on_group(best[GLOBAL_GROUP]["path"], frame, self.target_columns)
+                    if global_loss is not None and global_loss <= result["val_loss"]:
+                        print(f"Il modello globale batte quello di {group} "
+                              f"({global_loss:.4f} <= {result['val_loss']:.4f}): si userà il modello globale")
+                        global_preferred.append(group)
+                        continue
+
+                path = os.path.join(version_dir, f"model_{g}.safetensors")
+                os.replace(result["path"], path)
+                result["path"] = path
+                models[group] = {
+                    "path": os.path.relpath(path, self.output_dir),
+                    "val_loss": result["val_loss"],
+                    "global_val_loss": global_loss,
+                    "params": result["params"],
+                    "samples": len(frame),
+                }
+            shutil.rmtree(candidates_dir, ignore_errors=True)
+        except BaseException:
+            # Nessuna versione parziale: i candidati e i modelli già spostati vengono rimossi
+            shutil.rmtree(version_dir, ignore_errors=True)
+            raise
+
+        entry = {
+            "version": version,
+            "created_at": datetime.now().isoformat(),
+            "group_by": self.group_by,
+            "default": GLOBAL_GROUP,
+            "models": models,
+            "skipped_groups": skipped,
+            "global_preferred_groups": global_preferred,
+            "candidates": len(jobs),
+            "train_seconds": time.perf_counter() - start,
+        }
+
+        index = read_index(self.index_path)
+        index["versions"][version] = entry
+        if activate or index["current"] is None:
+            index["current"] = version
+        write_index(self.index_path, index)
+
+        print(f"Versione {version} scritta in {self.index_path} ({len(models)} modelli)")
+        return entry
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Addestramento dei modelli di CleanAI per sede o cliente")
+    parser.add_argument("--data", required=True, help="CSV con feature, gruppo e target")
+    parser.add_argument("--output", required=True, help="Cartella dei modelli e dell'indice")
+    parser.add_argument("--group-by", default="location_id")
+    parser.add_argument("--targets", nargs=3, default=list(DEFAULT_TARGET_COLUMNS))
+    parser.add_argument("--grid", help="JSON con la griglia di iperparametri")
+    parser.add_argument("--min-samples", type=int, default=50)
+    parser.add_argument("--processes", type=int)
+    parser.add_argument("--threads-per-worker", type=int)
+    parser.add_argument("--no-activate", action="store_true", help="Non rende corrente la nuova versione")
+    args = parser.parse_args()
+
+    orchestrator = TrainingOrchestrator(
+        args.output,
+        group_by=args.group_by,
+        param_grid=json.loads(args.grid) if args.grid else None,
+        target_columns=args.targets,
+        min_samples=args.min_samples,
+        processes=args.processes,
+        threads_per_worker=args.threads_per_worker,
+    )
+    entry = orchestrator.run(pd.read_csv(args.data), activate=not args.no_activate)
+    print(json.dumps(entry, indent=2))
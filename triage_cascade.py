@@ -0,0 +1,357 @@
+# Cascata di triage con visione artificiale classica prima dell'inferenza neurale
+# Calcola statistiche veloci su una copia ridotta dell'immagine (luminosità, varianza,
+# nitidezza e texture, anche per riquadro e come scarto locale dalla mediana) e decide
+# senza il modello YOLO-NAS le immagini chiaramente pulite o inutilizzabili
+# (troppo scure, troppo chiare o sfocate).
+#
+# Valutazione su dati etichettati:
+#   python triage_cascade.py --labels etichette.csv
+# dove etichette.csv contiene righe "percorso_immagine,clean|dirty".
+
+import argparse
+import csv
+import json
+import random
+import threading
+
+import cv2
+import numpy as np
+
+CLEAN = "clean"
+UNUSABLE = "unusable"
+UNCERTAIN = "uncertain"
+
+DEFAULT_THRESHOLDS = {
+    # Lato della copia ridotta su cui calcolare le statistiche
+    "downscale_size": 160,
+    # Luminosità media (0-255) sotto/sopra la quale l'immagine è inutilizzabile
+    "min_brightness": 35,
+    "max_brightness": 235,
+    # Varianza del laplaciano sotto la quale l'immagine è sfocata
+    "min_sharpness": 15.0,
+    # Un'immagine è pulita se varianza e densità dei bordi sono entrambe basse...
+    "clean_max_variance": 250.0,
+    "clean_max_edge_density": 0.02,
+    # ...e lo sono anche in ogni riquadro di una griglia tile_grid x tile_grid:
+    # le medie sull'intera immagine non vedono una macchia isolata
+    "tile_grid": 8,
+    "clean_max_tile_variance": 40.0,
+    "clean_max_tile_edge_density": 0.01,
+    # Scarto massimo (0-255) di un pixel dalla copia filtrata con mediana,
+    # per le macchie più piccole di un riquadro
+    "local_deviation_ksize": 9,
+    "clean_max_local_deviation": 25.0,
+    # Punteggio di pulizia assegnato alle immagini pulite
+    "clean_score": 0.95,
+}
+
+
+class TriageCascade:
+    """
+    Stadio di triage economico da eseguire prima del modello neurale
+    """
+
+    def __init__(self, thresholds=None, audit_rate=0.0, clean_score_threshold=0.9):
+        """
+        Inizializza la cascata
+
+        Args:
+            thresholds: Soglie da sovrascrivere rispetto a DEFAULT_THRESHOLDS
+            audit_rate: Frazione delle immagini dichiarate pulite che viene comunque
+                analizzata dal modello neurale per misurare la calibrazione
+            clean_score_threshold: Punteggio del modello neurale oltre il quale
+                un'immagine è considerata pulita nel confronto di calibrazione
+        """
+        self.thresholds = dict(DEFAULT_THRESHOLDS)
+        if thresholds:
+            self.thresholds.update(thresholds)
+        self.audit_rate = audit_rate
+        self.clean_score_threshold = clean_score_threshold
+
+        self._lock = threading.Lock()
+        self._random = random.Random()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats_counts = {CLEAN: 0, UNUSABLE: 0, UNCERTAIN: 0}
+            self.unusable_reasons = {}
+            # Immagini pulite inviate comunque al modello neurale per la verifica
+            self.audited = 0
+            # Confronto tra verdetto della cascata e modello neurale sulle immagini verificate
+            self.audit_counts = {
+                "clean_confirmed": 0,
+                "clean_rejected": 0,
+                "uncertain_clean": 0,
+                "uncertain_dirty": 0,
+            }
+
+    def compute_features(self, image):
+        """
+        Calcola le statistiche dell'immagine su una copia ridotta
+
+        Args:
+            image: Immagine RGB (o in scala di grigi) come array numpy
+
+        Returns:
+            Dizionario di feature
+        """
+        size = int(self.thresholds["downscale_size"])
+        height, width = image.shape[:2]
+        scale = size / max(height, width)
+        if scale < 1:
+            image = cv2.resize(image, (max(1, int(width * scale)), max(1, int(height * scale))),
+                               interpolation=cv2.INTER_AREA)
+
+        gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY) if image.ndim == 3 else image
+
+        # Le stesse statistiche usate da _simulate_analysis, più nitidezza e texture
+        brightness = float(np.mean(image))
+        variance = float(np.var(image))
+        sharpness = float(cv2.Laplacian(gray, cv2.CV_64F).var())
+        edges = cv2.Canny(gray, 50, 150)
+        edge_density = float(np.count_nonzero(edges)) / edges.size
+
+        # Statistiche del riquadro peggiore
+        grid = int(self.thresholds["tile_grid"])
+        tile_h, tile_w = max(1, gray.shape[0] // grid), max(1, gray.shape[1] // grid)
+        rows, cols = gray.shape[0] // tile_h, gray.shape[1] // tile_w
+        tiles = gray[:rows * tile_h, :cols * tile_w].astype(np.float64).reshape(rows, tile_h, cols, tile_w)
+        tile_edges = edges[:rows * tile_h, :cols * tile_w].reshape(rows, tile_h, cols, tile_w)
+        max_tile_variance = float(tiles.var(axis=(1, 3)).max())
+        max_tile_edge_density = float(np.count_nonzero(tile_edges, axis=(1, 3)).max()) / (tile_h * tile_w)
+
+        # Scarto locale dalla mediana, mediato su 3x3 per non reagire al rumore di un singolo pixel
+        ksize = int(self.thresholds["local_deviation_ksize"]) | 1
+        deviation = cv2.absdiff(gray, cv2.medianBlur(gray, ksize))
+        max_local_deviation = float(cv2.blur(deviation.astype(np.float32), (3, 3)).max())
+
+        return {
+            "brightness": brightness,
+            "variance": variance,
+            "sharpness": sharpness,
+            "edge_density": edge_density,
+            "max_tile_variance": max_tile_variance,
+            "max_tile_edge_density": max_tile_edge_density,
+            "max_local_deviation": max_local_deviation,
+        }
+
+    def classify(self, features):
+        """
+        Decide il verdetto a partire dalle feature
+
+        Returns:
+            Tupla (verdetto, motivo)
+        """
+        t = self.thresholds
+        if features["brightness"] < t["min_brightness"]:
+            return UNUSABLE, "too_dark"
+        if features["brightness"] > t["max_brightness"]:
+            return UNUSABLE, "too_bright"
+        if features["sharpness"] < t["min_sharpness"]:
+            # Con varianza alta l'immagine è sfocata. Con varianza bassa può essere una
+            # superficie uniforme o una sfocatura che nasconde lo sporco: non potendole
+            # distinguere, un'immagine poco nitida non viene mai dichiarata pulita
+            if features["variance"] > t["clean_max_variance"]:
+                return UNUSABLE, "blurred"
+            return UNCERTAIN, "low_sharpness"
+        if features["variance"] > t["clean_max_variance"] or features["edge_density"] > t["clean_max_edge_density"]:
+            return UNCERTAIN, None
+        # Basta un riquadro o una zona fuori soglia perché decida il modello
+        if (features["max_tile_variance"] > t["clean_max_tile_variance"]
+                or features["max_tile_edge_density"] > t["clean_max_tile_edge_density"]
+                or features["max_local_deviation"] > t["clean_max_local_deviation"]):
+            return UNCERTAIN, "local_defect"
+        return CLEAN, "low_texture"
+
+    def evaluate(self, image):
+        """
+        Esegue la cascata su un'immagine e aggiorna le statistiche
+
+        Args:
+            image: Immagine RGB come array numpy
+
+        Returns:
+            Dizionario con verdetto, motivo, feature e flag di verifica
+        """
+        features = self.compute_features(image)
+        verdict, reason = self.classify(features)
+
+        with self._lock:
+            self.stats_counts[verdict] += 1
+            if verdict == UNUSABLE:
+                self.unusable_reasons[reason] = self.unusable_reasons.get(reason, 0) + 1
+            audit = verdict == CLEAN and self._random.random() < self.audit_rate
+            if audit:
+                self.audited += 1
+
+        return {
+            "verdict": verdict,
+            "reason": reason,
+            "features": {k: round(v, 4) for k, v in features.items()},
+            "audit": audit,
+        }
+
+    def build_result(self, triage, summary_fn):
+        """
+        Costruisce il risultato dell'analisi per un'immagine decisa dalla cascata
+
+        Args:
+            triage: Risultato di evaluate()
+            summary_fn: Funzione (detections, score) -> riepilogo testuale
+
+        Returns:
+            Dizionario nello stesso formato di SurfaceAnalyzer.analyze_surface
+        """
+        if triage["verdict"] == UNUSABLE:
+            return {
+                "error": f"Immagine non utilizzabile ({triage['reason']})",
+                "unusable": True,
+                "triage": triage,
+            }
+
+        score = float(self.thresholds["clean_score"])
+        return {
+            "detections": [],
+            "cleanliness_score": score,
+            "analysis_summary": summary_fn([], score),
+            "triage": triage,
+        }
+
+    def record_audit(self, triage, neural_result):
+        """
+        Registra il confronto tra verdetto della cascata e risultato del modello neurale.
+        Le immagini incerte mostrano quante immagini pulite la cascata non ha saltato.
+        """
+        if "cleanliness_score" not in neural_result or triage["verdict"] == UNUSABLE:
+            return
+        neural_clean = neural_result["cleanliness_score"] >= self.clean_score_threshold
+        with self._lock:
+            if triage["verdict"] == CLEAN:
+                key = "clean_confirmed" if neural_clean else "clean_rejected"
+            else:
+                key = "uncertain_clean" if neural_clean else "uncertain_dirty"
+            self.audit_counts[key] += 1
+
+    def stats(self):
+        """
+        Restituisce tasso di salto e statistiche di calibrazione
+        """
+        with self._lock:
+            total = sum(self.stats_counts.values())
+            # Le immagini pulite verificate passano comunque dal modello neurale
+            skipped = self.stats_counts[CLEAN] - self.audited + self.stats_counts[UNUSABLE]
+            audited_clean = self.audit_counts["clean_confirmed"] + self.audit_counts["clean_rejected"]
+            return {
+                "thresholds": dict(self.thresholds),
+                "images": total,
+                "verdicts": dict(self.stats_counts),
+                "unusable_reasons": dict(self.unusable_reasons),
+                "skip_rate": skipped / total if total else 0.0,
+                "audit_rate": self.audit_rate,
+                "audited": self.audited,
+                "audit": dict(self.audit_counts),
+                # Frazione dei verdetti "pulito" confermata dal modello neurale
+                "clean_precision": self.audit_counts["clean_confirmed"] / audited_clean if audited_clean else None,
+            }
+
+
+def evaluate_labelled(cascade, samples, features=None):
+    """
+    Valuta la cascata su immagini etichettate
+
+    Args:
+        cascade: Istanza di TriageCascade
+        samples: Lista di tuple (immagine RGB, etichetta "clean"/"dirty"/"unusable")
+        features: Feature già calcolate per ogni campione, nello stesso ordine (opzionale)
+
+    Returns:
+        Dizionario con matrice di confusione, tasso di salto e precisione dei verdetti
+    """
+    if features is None:
+        features = [cascade.compute_features(image) for image, _ in samples]
+
+    confusion = {}
+    for f, (_, label) in zip(features, samples):
+        verdict, _ = cascade.classify(f)
+        confusion.setdefault(verdict, {}).setdefault(label, 0)
+        confusion[verdict][label] += 1
+
+    total = len(samples)
+    clean_row = confusion.get(CLEAN, {})
+    unusable_row = confusion.get(UNUSABLE, {})
+    clean_total = sum(clean_row.values())
+    unusable_total = sum(unusable_row.values())
+
+    return {
+        "samples": total,
+        "confusion": confusion,
+        "skip_rate": (clean_total + unusable_total) / total if total else 0.0,
+        "clean_precision": clean_row.get("clean", 0) / clean_total if clean_total else None,
+        # Immagini sporche che la cascata avrebbe dichiarato pulite: l'errore più costoso
+        "dirty_marked_clean": clean_row.get("dirty", 0),
+        "unusable_precision": unusable_row.get("unusable", 0) / unusable_total if unusable_total else None,
+    }
+
+
+def sweep_clean_thresholds(samples, variances, edge_densities, base_thresholds=None):
+    """
+    Valuta la cascata su una griglia di soglie per il verdetto "pulito"
+
+    Returns:
+        Lista di risultati ordinata per tasso di salto, tra quelli senza
+        immagini sporche dichiarate pulite in testa
+    """
+    results = []
+    features = None
+    for variance in variances:
+        for edge_density in edge_densities:
+            thresholds = dict(base_thresholds or {})
+            thresholds.update({"clean_max_variance": variance, "clean_max_edge_density": edge_density})
+            cascade = TriageCascade(thresholds)
+            # Le feature non dipendono da queste soglie: si calcolano una volta sola
+            if features is None:
+                features = [cascade.compute_features(image) for image, _ in samples]
+
+            report = evaluate_labelled(cascade, samples, features)
+            results.append({
+                "clean_max_variance": variance,
+                "clean_max_edge_density": edge_density,
+                "skip_rate": report["skip_rate"],
+                "dirty_marked_clean": report["dirty_marked_clean"],
+            })
+
+    results.sort(key=lambda r: (r["dirty_marked_clean"], -r["skip_rate"]))
+    return results
+
+
+def load_labelled_samples(labels_path):
+    samples = []
+    with open(labels_path) as f:
+        for row in csv.reader(f):
+            if len(row) < 2 or row[0].startswith("#"):
+                continue
+            image = cv2.imread(row[0])
+            if image is None:
+                print(f"Immagine non leggibile: {row[0]}")
+                continue
+            samples.append((cv2.cvtColor(image, cv2.COLOR_BGR2RGB), row[1].strip().lower()))
+    return samples
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Valutazione della cascata di triage su immagini etichettate")
+    parser.add_argument("--labels", required=True, help="CSV con righe percorso_immagine,etichetta")
+    parser.add_argument("--thresholds", help="JSON con le soglie da sovrascrivere")
+    parser.add_argument("--sweep", action="store_true", help="Esplora una griglia di soglie per il verdetto pulito")
+    args = parser.parse_args()
+
+    thresholds = json.loads(args.thresholds) if args.thresholds else None
+    samples = load_labelled_samples(args.labels)
+
+    print(json.dumps(evaluate_labelled(TriageCascade(thresholds), samples), indent=2))
+
+    if args.sweep:
+        sweep = sweep_clean_thresholds(samples, [100, 150, 250, 400, 600, 1000],
+                                       [0.005, 0.01, 0.02, 0.04, 0.08], thresholds)
+        print(json.dumps(sweep[:10], indent=2))